@@ -0,0 +1,242 @@
+import os
+import sys
+import glob
+import json
+import hashlib
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+from skimage import io
+import AFT_tools as AFT
+import AFT_pipeline
+
+# file names of the result tables of every metric
+RESULT_NAMES = ('AFT_AI', 'AFT_order', 'segmentation_features')
+
+def image_label(im_file):
+    # name of the image as it is in the spot table
+    return os.path.basename(im_file).replace('.tif', '')
+
+def image_fingerprint(im_file, parameters, df_spots=None, im_mask=None):
+    """
+    Fingerprint of an image file, its tracks, the mask and the analysis parameters.
+
+    A shard is reused only if its fingerprint matches, so changing the image
+    file, its tracks or any parameter reruns the image.
+    """
+    stat = os.stat(im_file)
+    fingerprint = hashlib.sha1(json.dumps(parameters, sort_keys=True, default=str).encode())
+    fingerprint.update(str((os.path.abspath(im_file), stat.st_size, stat.st_mtime_ns)).encode())
+    if df_spots is not None:
+        df_subset = df_spots.loc[df_spots.File_name_raw == image_label(im_file)]
+        fingerprint.update(pd.util.hash_pandas_object(df_subset).to_numpy().tobytes())
+    if im_mask is not None:
+        fingerprint.update(AFT.image_hash(im_mask).encode())
+    return fingerprint.hexdigest()
+
+def shard_key(im_file):
+    # file name prefix of the shards of an image, the label and a short hash of the full path
+    # so images with the same name in different folders don't share shards
+    return '%s_%s' % (image_label(im_file), hashlib.sha1(os.path.abspath(im_file).encode()).hexdigest()[:10])
+
+def shard_paths(shard_dir, im_file):
+    # result shards and fingerprint file of an image
+    key = shard_key(im_file)
+    shards = {name: os.path.join(shard_dir, f"{key}_{name}.csv") for name in RESULT_NAMES}
+    return shards, os.path.join(shard_dir, f"{key}.json")
+
+def duplicate_labels(im_list):
+    # images that have the same label, the spot table (File_name_raw) and the result tables can't tell them apart
+    files = {}
+    for im_file in im_list:
+        files.setdefault(image_label(im_file), []).append(im_file)
+    return {label: label_files for label, label_files in files.items() if len(label_files) > 1}
+
+def image_spots(df_spots, im_list):
+    # the tracks of every image, so only its own tracks are sent with an image to a worker
+    if df_spots is None:
+        return {im_file: None for im_file in im_list}
+    groups = dict(list(df_spots.groupby('File_name_raw', sort=False)))
+    return {im_file: groups.get(image_label(im_file), df_spots.iloc[:0]) for im_file in im_list}
+
+def attrs_as_columns(df):
+    # the parameters kept in df.attrs (the same for every row) as columns, a csv file doesn't store the attrs
+    return df.assign(**df.attrs) if df.attrs else df
+
+def write_atomic(path, write):
+    # write to a temporary file first so a crash never leaves a half written shard
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    write(temp_path)
+    os.replace(temp_path, path)
+
+def write_json(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f, default=str)
+
+def process_image(im_file, shard_dir, parameters, df_spots=None, im_mask=None,
+                  segmentation_parameters=None, overlay_parameters=None, cache_dir=None):
+    """
+    Analyse one image and write its result shards, unless they are up to date.
+
+    Returns
+    -------
+    status : str
+        'skipped' if the shards of an earlier run were reused, 'done' otherwise.
+    """
+    shards, fingerprint_file = shard_paths(shard_dir, im_file)
+    fingerprint = image_fingerprint(im_file, parameters, df_spots, im_mask)
+
+    # skip the image if it was analysed with the same inputs before
+    if os.path.isfile(fingerprint_file):
+        with open(fingerprint_file) as f:
+            if json.load(f).get('fingerprint') == fingerprint:
+                return 'skipped'
+
+    results = AFT_pipeline.AFT_pipeline(
+        [im_file], parameters['window_size'], parameters['overlap'],
+        im_mask=im_mask, intensity_thresh=parameters['intensity_thresh'],
+        eccentricity_thresh=parameters['eccentricity_thresh'], single_frame=parameters['single_frame'],
+        df_spots=df_spots, neighborhood_radius=parameters['neighborhood_radius'],
+        segmentation_parameters=segmentation_parameters, overlay_parameters=overlay_parameters,
+        cache_dir=cache_dir
+    )
+
+    for name, df in zip(RESULT_NAMES, results):
+        if df is not None:
+            write_atomic(shards[name], lambda path: attrs_as_columns(df).to_csv(path, index=False))
+        elif os.path.isfile(shards[name]):
+            # remove the shard of a metric of an earlier run that isn't calculated anymore
+            os.remove(shards[name])
+
+    # the fingerprint is written last, it marks the image as finished
+    write_atomic(fingerprint_file, lambda path: write_json(path, {'image': im_file, 'fingerprint': fingerprint,
+                                                                  'parameters': parameters}))
+    return 'done'
+
+def try_process_image(im_file, **kwargs):
+    # a failed image is reported (with its traceback) instead of stopping the batch
+    try:
+        return process_image(im_file, **kwargs), None
+    except Exception:
+        return 'failed', traceback.format_exc()
+
+def merge_shards(im_list, shard_dir, output_dir):
+    """
+    Concatenate the shards of all images (in the order of im_list) into one table per metric.
+
+    Returns
+    -------
+    merged : dict
+        Merged DataFrame of every metric that has shards.
+    """
+    merged = {}
+    for name in RESULT_NAMES:
+        tables = []
+        for im_file in im_list:
+            path = shard_paths(shard_dir, im_file)[0][name]
+            if os.path.isfile(path):
+                try:
+                    tables.append(pd.read_csv(path))
+                except pd.errors.EmptyDataError:
+                    # images without any records
+                    continue
+        merged_file = os.path.join(output_dir, f"{name}.csv")
+        if tables:
+            merged[name] = pd.concat(tables, ignore_index=True)
+            merged[name].to_csv(merged_file, index=False)
+        elif os.path.isfile(merged_file):
+            # remove the table of a metric of an earlier run that isn't calculated anymore
+            os.remove(merged_file)
+    return merged
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Run AFT, the track alignment, the local order and the segmentation '
+                                                 'features on a batch of images, with one result shard per image.')
+    parser.add_argument('images', nargs='+', help='image files, or folders of .tif images')
+    parser.add_argument('-o', '--output', required=True, help='results folder')
+    parser.add_argument('--window-size', type=int, required=True, help='AFT window size (px)')
+    parser.add_argument('--overlap', type=float, required=True, help='overlap between windows')
+    parser.add_argument('--intensity-thresh', type=float, default=0, help='AFT intensity threshold')
+    parser.add_argument('--eccentricity-thresh', type=float, default=0, help='AFT eccentricity threshold')
+    parser.add_argument('--single-frame', action='store_true', help='only analyse the first frame of every image')
+    parser.add_argument('--mask', help='mask image for AFT')
+    parser.add_argument('--spots', help='spot table (csv) to calculate the track alignment')
+    parser.add_argument('--neighborhood-radius', type=int, help='neighborhood radius to calculate the local order parameter')
+    parser.add_argument('--segmentation', help='json file with the parameters of segmentation_features (needs the fractal '
+                                               'package, https://github.com/wanglab-georgetown/fractal, on the python path)')
+    parser.add_argument('--overlay-folder', help='folder to save the track overlays in (needs --spots)')
+    parser.add_argument('--px-size-x', type=float, default=1, help='pixel size in x for the overlays')
+    parser.add_argument('--px-size-y', type=float, default=1, help='pixel size in y for the overlays')
+    parser.add_argument('--cache-dir', help='folder of cached AFT orientation fields')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of images analysed in parallel')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_arguments(argv)
+
+    # list the images, folders are searched for tif files
+    im_list = []
+    for path in args.images:
+        im_list.extend(sorted(glob.glob(os.path.join(path, '*.tif'))) if os.path.isdir(path) else [path])
+
+    # the images are matched to their tracks and named in the results by their label, so it has to be unique
+    duplicates = duplicate_labels(im_list)
+    if duplicates:
+        print("Images with the same name can't be told apart in the spot table and the results, rename them or run them "
+              "in separate batches:", *(f"{label}: {', '.join(files)}" for label, files in duplicates.items()),
+              sep='\n  ', file=sys.stderr)
+        return 2
+
+    df_spots = pd.read_csv(args.spots) if args.spots else None
+    im_mask = io.imread(args.mask) if args.mask else None
+    segmentation_parameters = None
+    if args.segmentation:
+        with open(args.segmentation) as f:
+            segmentation_parameters = json.load(f)
+    overlay_parameters = None
+    if args.overlay_folder:
+        overlay_parameters = dict(px_size_x=args.px_size_x, px_size_y=args.px_size_y, output_image_folder=args.overlay_folder)
+
+    parameters = dict(window_size=args.window_size, overlap=args.overlap, intensity_thresh=args.intensity_thresh,
+                      eccentricity_thresh=args.eccentricity_thresh, single_frame=args.single_frame,
+                      neighborhood_radius=args.neighborhood_radius, segmentation=segmentation_parameters,
+                      overlays=overlay_parameters)
+
+    shard_dir = os.path.join(args.output, 'shards')
+    os.makedirs(shard_dir, exist_ok=True)
+    spots = image_spots(df_spots, im_list)
+    run_image = dict(shard_dir=shard_dir, parameters=parameters, im_mask=im_mask,
+                     segmentation_parameters=segmentation_parameters, overlay_parameters=overlay_parameters,
+                     cache_dir=args.cache_dir)
+
+    # analyse the images, in parallel if there are several jobs
+    if args.jobs > 1:
+        pool = ProcessPoolExecutor(max_workers=args.jobs)
+        futures = {pool.submit(try_process_image, im_file, df_spots=spots[im_file], **run_image): im_file for im_file in im_list}
+        outcomes = ((futures[future], future.result()) for future in as_completed(futures))
+    else:
+        pool = None
+        outcomes = ((im_file, try_process_image(im_file, df_spots=spots[im_file], **run_image)) for im_file in im_list)
+
+    failed = []
+    for count, (im_file, (status, error)) in enumerate(outcomes, 1):
+        print(f"[{count}/{len(im_list)}] {os.path.basename(im_file)}: {status}", flush=True)
+        if error is not None:
+            print(error, flush=True)
+            failed.append(im_file)
+    if pool is not None:
+        pool.shutdown()
+
+    # merge the shards of all images
+    merged = merge_shards(im_list, shard_dir, args.output)
+    for name, df in merged.items():
+        print(f"{name}: {len(df)} rows -> {os.path.join(args.output, name + '.csv')}")
+
+    if failed:
+        print(f"{len(failed)} image(s) failed, rerun the same command to retry them:", *failed, sep='\n  ')
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
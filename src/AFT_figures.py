@@ -10,7 +10,7 @@ import AFT_tools as AFT
 def AFT_preview(im_list, Results_Folder,
                     window_size, overlap,
                     neighborhood_radius, eccentricity_thresh,
-                    im_mask=None, intensity_thresh=None):
+                    im_mask=None, intensity_thresh=None, cache_dir=None):
     """
     Run AFT preview analysis on the first image from im_list.
 
@@ -32,6 +32,9 @@ def AFT_preview(im_list, Results_Folder,
         Binary mask image (same shape as input image).
     intensity_thresh : float, optional
         Intensity threshold for AFT.
+    cache_dir : str, optional
+        Folder of cached AFT orientation fields. The field of an image and
+        parameter set is computed once and read back on later calls.
 
     Returns
     -------
@@ -62,7 +65,7 @@ def AFT_preview(im_list, Results_Folder,
         preview_image, window_size, overlap,
         im_mask, intensity_thresh, eccentricity_thresh,
         plot_overlay=False, plot_angles=False, plot_eccentricity=False,
-        save_figures=False, save_path=''
+        save_figures=False, save_path='', cache_dir=cache_dir
     )
 
     # --- Build output filename (append variables) ---
@@ -151,7 +154,8 @@ def plot_AFT_overlays(
     single_frame,
     px_size_x,
     px_size_y,
-    output_image_folder
+    output_image_folder,
+    cache_dir=None
 ):
     """
     Plot and save overlays of AFT orientation field with tracks.
@@ -182,6 +186,8 @@ def plot_AFT_overlays(
         Pixel size in y (for scaling positions).
     output_image_folder : str, optional
         Folder where overlays will be saved.
+    cache_dir : str, optional
+        Folder of cached AFT orientation fields (default: None).
     """
     im_list_current = []
 
@@ -193,8 +199,6 @@ def plot_AFT_overlays(
 
     im_list_current = np.array(im_list_current)
 
-    cmap = plt.get_cmap('hsv')
-
     for position in range(len(im_list_current)):
         # Load current image
         im = io.imread(im_list[position])
@@ -206,70 +210,115 @@ def plot_AFT_overlays(
             im, window_size, overlap,
             im_mask, intensity_thresh, eccentricity_thresh,
             plot_overlay=False, plot_angles=False, plot_eccentricity=False,
-            save_figures=False, save_path=''
+            save_figures=False, save_path='', cache_dir=cache_dir
+        )
+
+        # Plot the overlays of every time point
+        plot_image_AFT_overlays(
+            im, x, y, u, v, df_subset_out, im_list_current[position],
+            overlap, single_frame, px_size_x, px_size_y, output_image_folder
         )
 
-        # Subset tracks for current image
-        df_temp = df_subset_out.loc[df_subset_out.File_name_raw == im_list_current[position]].copy()
-        df_temp['POSITION_X'] = df_temp['POSITION_X'] * px_size_x
-        df_temp['POSITION_Y'] = df_temp['POSITION_Y'] * px_size_y
-
-        # Create folder for current sequence
-        sequence_folder = os.path.join(output_image_folder, df_temp.File_name_raw.unique()[0])
-        os.makedirs(sequence_folder, exist_ok=True)
-
-        # Loop over time points
-        for time_point in range(len(df_temp.FRAME.unique()) - 1):
-            plt.figure(frameon=False)
-
-            if single_frame is False:
-                plt.imshow(im[time_point,], cmap='gray', aspect='equal')
-            else:
-                plt.imshow(im, cmap='gray', aspect='equal')
-
-            plt.gca().set_aspect('equal', adjustable='box')
-
-            # Plot all tracks
-            for track in df_temp.TRACK_ID.unique():
-                plt.plot(
-                    df_temp.loc[df_temp.TRACK_ID == track, 'POSITION_X'],
-                    df_temp.loc[df_temp.TRACK_ID == track, 'POSITION_Y'],
-                    linewidth=1, color='w'
-                )
-
-            # Plot AFT field
-            if single_frame is False:
-                plt.quiver(
-                    x, y, u[time_point], v[time_point],
-                    color='yellow', pivot='mid', scale_units='xy',
-                    scale=overlap, headaxislength=0, headlength=0,
-                    width=0.005, alpha=0.4
-                )
-            else:
-                plt.quiver(
-                    x, y, u, v,
-                    color='yellow', pivot='mid', scale_units='xy',
-                    scale=overlap, headaxislength=0, headlength=0,
-                    width=0.005, alpha=0.4
-                )
-
-            # Plot current position marker
+def plot_image_AFT_overlays(
+    im,
+    x,
+    y,
+    u,
+    v,
+    df_subset_out,
+    label,
+    overlap,
+    single_frame,
+    px_size_x,
+    px_size_y,
+    output_image_folder
+):
+    """
+    Plot and save overlays of the AFT orientation field of one image with its tracks.
+
+    Parameters
+    ----------
+    im : np.array
+        Image (or stack of frames) the AFT field was measured on.
+    x, y, u, v : np.array
+        Window positions and orientation vectors from AFT.image_local_order.
+    df_subset_out : pd.DataFrame
+        DataFrame with track info and file names.
+    label : str
+        Name of the image in df_subset_out.File_name_raw.
+    overlap : float
+        AFT overlap.
+    single_frame : bool
+        Whether images are single-frame.
+    px_size_x : float
+        Pixel size in x (for scaling positions).
+    px_size_y : float
+        Pixel size in y (for scaling positions).
+    output_image_folder : str
+        Folder where overlays will be saved.
+    """
+    cmap = plt.get_cmap('hsv')
+
+    # Subset tracks for current image
+    df_temp = df_subset_out.loc[df_subset_out.File_name_raw == label].copy()
+    df_temp['POSITION_X'] = df_temp['POSITION_X'] * px_size_x
+    df_temp['POSITION_Y'] = df_temp['POSITION_Y'] * px_size_y
+
+    # Create folder for current sequence
+    sequence_folder = os.path.join(output_image_folder, df_temp.File_name_raw.unique()[0])
+    os.makedirs(sequence_folder, exist_ok=True)
+
+    # Loop over time points
+    for time_point in range(len(df_temp.FRAME.unique()) - 1):
+        plt.figure(frameon=False)
+
+        if single_frame is False:
+            plt.imshow(im[time_point,], cmap='gray', aspect='equal')
+        else:
+            plt.imshow(im, cmap='gray', aspect='equal')
+
+        plt.gca().set_aspect('equal', adjustable='box')
+
+        # Plot all tracks
+        for track in df_temp.TRACK_ID.unique():
             plt.plot(
-                df_temp.loc[time_point, 'POSITION_X'],
-                df_temp.loc[time_point, 'POSITION_Y'],
-                marker='o', linestyle='None', color=cmap(time_point * 2)
+                df_temp.loc[df_temp.TRACK_ID == track, 'POSITION_X'],
+                df_temp.loc[df_temp.TRACK_ID == track, 'POSITION_Y'],
+                linewidth=1, color='w'
             )
 
-            plt.axis('off')
-
-            file_name = (
-                f"{df_temp.Condition.unique()[0]}_"
-                f"{df_temp.File_name_raw.unique()[0]}_"
-                f"Overlay_AFT_single_frame_{single_frame}_"
-                f"frame_{time_point}.png"
+        # Plot AFT field
+        if single_frame is False:
+            plt.quiver(
+                x, y, u[time_point], v[time_point],
+                color='yellow', pivot='mid', scale_units='xy',
+                scale=overlap, headaxislength=0, headlength=0,
+                width=0.005, alpha=0.4
+            )
+        else:
+            plt.quiver(
+                x, y, u, v,
+                color='yellow', pivot='mid', scale_units='xy',
+                scale=overlap, headaxislength=0, headlength=0,
+                width=0.005, alpha=0.4
             )
 
-            save_path = os.path.join(sequence_folder, file_name)
-            plt.savefig(save_path, dpi=300, bbox_inches='tight')
-            plt.close()
+        # Plot current position marker
+        plt.plot(
+            df_temp.loc[time_point, 'POSITION_X'],
+            df_temp.loc[time_point, 'POSITION_Y'],
+            marker='o', linestyle='None', color=cmap(time_point * 2)
+        )
+
+        plt.axis('off')
+
+        file_name = (
+            f"{df_temp.Condition.unique()[0]}_"
+            f"{df_temp.File_name_raw.unique()[0]}_"
+            f"Overlay_AFT_single_frame_{single_frame}_"
+            f"frame_{time_point}.png"
+        )
 
+        save_path = os.path.join(sequence_folder, file_name)
+        plt.savefig(save_path, dpi=300, bbox_inches='tight')
+        plt.close()
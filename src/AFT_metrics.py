@@ -1,22 +1,124 @@
 import numpy as np
 import pandas as pd
 from skimage import io
-from scipy import spatial
 import os
 import sys
+from collections import OrderedDict
 from scipy.fft import fft2, fftshift, ifft2, ifftshift, fft, ifft, fftfreq
 import cv2                                                     # for filtering vector fields
 from skimage.morphology import disk        # morphology operations
-import numpy.matlib as matlib
 import matplotlib.pyplot as plt
 from scipy.stats import mannwhitneyu
 import os
 sys.path.append('/content/AFT-Alignment_by_Fourier_Transform/Python_implementation')
 import AFT_tools as AFT
 
+def track_steps(df_subset):
+    """
+    Sort the spots of an image into tracks and pair every position with the next one of its track.
+
+    Tracks keep the order they first appear in the spot table, the spots of a
+    track are sorted by FRAME and only the first spot of a repeated frame is
+    kept (the same as sorting and dropping duplicates track by track).
+
+    Returns:
+    --------
+    df_tracks : pd.DataFrame
+        Spots of all tracks, sorted.
+    current : np.array
+        Row of df_tracks of every position that has a next one (all but the
+        last position of each track), the next position is the row after it.
+    time_point : np.array
+        Index of every current position within its track.
+    """
+    # tracks in order of appearance (spots without a TRACK_ID aren't in a track), each sorted by frame
+    track_codes = pd.factorize(df_subset['TRACK_ID'])[0]
+    rows = np.flatnonzero(track_codes >= 0)
+    rows = rows[np.lexsort((df_subset['FRAME'].to_numpy()[rows], track_codes[rows]))]
+    df_tracks = df_subset.iloc[rows]
+    first = ~df_tracks.duplicated(subset=['TRACK_ID', 'FRAME']).to_numpy()
+    df_tracks = df_tracks.iloc[np.flatnonzero(first)].reset_index(drop=True)
+    track_codes = track_codes[rows][first]
+
+    # every position followed by one of the same track
+    new_track = np.r_[True, track_codes[1:] != track_codes[:-1]]
+    current = np.flatnonzero(~new_track[1:])
+    time_point = np.arange(len(track_codes)) - np.flatnonzero(new_track)[np.cumsum(new_track) - 1]
+
+    return df_tracks, current, time_point[current]
+
+def track_alignment(df_subset, label, x, y, im_theta, im_eccentricity):
+    """
+    Calculate alignment of the tracks of one image with its AFT orientation field.
+
+    Parameters:
+    -----------
+    df_subset : pd.DataFrame
+        Spot positions and tracks of the image.
+    label : str
+        Name of the image in the spot table.
+    x, y : np.array
+        Window positions returned by AFT.image_local_order.
+    im_theta, im_eccentricity : np.array or list
+        Orientation and eccentricity returned by AFT.image_local_order.
+
+    Returns:
+    --------
+    df_track_out : pd.DataFrame
+        DataFrame with track-AFT alignment metrics for the image.
+    """
+    df_tracks, current, time_point = track_steps(df_subset)
+    position_x = df_tracks['POSITION_X'].to_numpy()
+    position_y = df_tracks['POSITION_Y'].to_numpy()
+
+    # closest point in AFT_coords of every position, from one KDTree for the whole image
+    idx_closest = AFT.nearest_window(x, y, np.column_stack((position_x[current], position_y[current])))
+
+    # AFT angle and eccentricity of the closest window, in the frame of the time point for a stack
+    theta = np.asarray(im_theta, dtype='float64')
+    eccentricity = np.asarray(im_eccentricity, dtype='float64')
+    n_windows = len(x)
+    flat_index = idx_closest if theta.ndim == 2 else time_point * n_windows + idx_closest
+    AFT_angle = np.ravel(theta)[flat_index]
+    AFT_ecc = np.ravel(eccentricity)[flat_index]
+
+    # Track angle from the step to the next position
+    dx = position_x[current + 1] - position_x[current]
+    dy = position_y[current + 1] - position_y[current]
+    norm = np.sqrt(dx**2 + dy**2)
+    track_angle = np.arctan2(dy/norm, dx/norm)
+
+    # Calculate alignment metrics
+    AFT_track_angle = AFT_angle - track_angle
+    AFT_track_angle_cos2 = np.cos(AFT_track_angle)**2
+
+    # Build output DataFrame, the spots followed by the metrics
+    df_out = pd.DataFrame({
+        'image_name': label,
+        'ECM_x': np.asarray(x)[idx_closest],
+        'ECM_y': np.asarray(y)[idx_closest],
+        'track_angle': track_angle,
+        'AFT_angle': AFT_angle,
+        'AFT-Δφ': AFT_track_angle,
+        'AFT-AI': AFT_track_angle_cos2,
+        'AFT_eccentricity': AFT_ecc,
+        'track_angle_u': np.cos(track_angle),
+        'track_angle_v': np.sin(track_angle),
+        'AFT_angle_u': np.cos(AFT_angle),
+        'AFT_angle_v': np.sin(AFT_angle)
+    })
+    df_out = pd.concat([df_tracks.iloc[current].reset_index(drop=True), df_out], axis=1)
+
+    # columns in the same order as before
+    df_track_out = pd.DataFrame(columns=[
+        'TRACK_ID','FRAME','track_angle','AFT_angle',
+        'track_angle_u','track_angle_v','AFT_angle_u','AFT_angle_v'
+    ])
+    return pd.concat([df_track_out, df_out], ignore_index=True)
+
 def AFT_AI_metric(im_list, df_spots, window_size, overlap,
                   im_mask=None, intensity_thresh=0, eccentricity_thresh=0,
-                  single_frame=False):
+                  single_frame=False, sparse=False, cache_dir=None, sparse_cache=None):
     """
     Calculate alignment of tracks with local fiber orientation using AFT.
     
@@ -38,6 +140,17 @@ def AFT_AI_metric(im_list, df_spots, window_size, overlap,
         Eccentricity threshold for AFT (default: 0).
     single_frame : bool, optional
         Whether images are single-frame (default: False).
+    sparse : bool, optional
+        Only run AFT on the windows nearest the track positions instead of
+        the full grid (default: False). The angles at those windows are the
+        same as with the full grid.
+    cache_dir : str, optional
+        Folder of cached AFT orientation fields, used for the full grid
+        (default: None).
+    sparse_cache : collections.OrderedDict, optional
+        In-memory cache of the sparse AFT windows, kept across the images and
+        across calls when the same one is passed again (default: None, a new
+        cache for this call).
     
     Returns:
     --------
@@ -56,7 +169,12 @@ def AFT_AI_metric(im_list, df_spots, window_size, overlap,
 
     im_list_current = np.array(im_list_current)
 
-    df_subset_out = pd.DataFrame()
+    # tables of all images, concatenated once at the end
+    image_tables = [pd.DataFrame()]
+
+    # one cache of sparse windows for all the images (its keys include the image hash and the AFT parameters)
+    if sparse and sparse_cache is None:
+        sparse_cache = OrderedDict()
 
     for position in range(len(im_list_current)):
         # Load current image
@@ -64,109 +182,86 @@ def AFT_AI_metric(im_list, df_spots, window_size, overlap,
         if im.ndim == 3 and single_frame:
             im = im[0,] #take only first frame
 
-        # Run AFT on image
-        x, y, u, v, im_theta, im_eccentricity = AFT.image_local_order(
-            im, window_size, overlap,
-            im_mask, intensity_thresh, eccentricity_thresh,
-            plot_overlay=False, plot_angles=False, plot_eccentricity=False,
-            save_figures=False, save_path=''
-        )
-
-        # Prepare AFT coordinates
-        AFT_coords = np.column_stack((x, y))
-        ECM_labels = [f"ECM_{i+1}" for i in range(len(AFT_coords))] #give a unique ID for each ECM
-
         # Get subset of tracks for this image
         df_subset = df_spots.loc[df_spots.File_name_raw == im_list_current[position]]
 
-        df_track_out = pd.DataFrame(columns=[
-            'TRACK_ID','FRAME','track_angle','AFT_angle',
-            'track_angle_u','track_angle_v','AFT_angle_u','AFT_angle_v'
-        ])
-        ###### maybe process each track not through the cycle and addition to the empty list but through the pandas df?
-        # Process each track
-        for trackID in df_subset.TRACK_ID.unique():
-            df_track = df_subset.loc[df_subset.TRACK_ID == trackID].sort_values('FRAME').drop_duplicates(subset=['FRAME'], ignore_index=True) # take part of the Spot table with unique Trac_ID
-
-            AFT_angle, track_angle, current_time_point, AFT_ecc, ECM_nearest, ECM_x, ECM_y = [], [], [], [], [], [], [] #create empty lists for each feature
-
-            for time_point in range(len(df_track)-1):
-                ######## maybe do start and finnish point through the shift(-1)? 
-                track_current = [df_track.loc[time_point, 'POSITION_X'], df_track.loc[time_point, 'POSITION_Y']] #extract start point 
-                track_next = [df_track.loc[time_point+1, 'POSITION_X'], df_track.loc[time_point+1, 'POSITION_Y']] #extract finish point 
-
-                d_closest, idx_closest = spatial.KDTree(AFT_coords).query(track_current) #use KDTree to define closest point in AFT_coords
-                closest_ECM_ID = ECM_labels[idx_closest] #define closest ECM_ID
-
-                #append to the lists with variables 
-                ECM_nearest.append(closest_ECM_ID)
-                ECM_x.append(np.array(AFT_coords[idx_closest])[0])
-                ECM_y.append(np.array(AFT_coords[idx_closest])[1])
-
-                # Get AFT angle and eccentristy 
-                if isinstance(im_theta, np.ndarray): #check that it comes in np.ndarray format
-                    if im_theta.ndim == 2:  # single frame
-                        AFT_angle.append(np.ravel(im_theta)[idx_closest]) #in 1D array
-                        AFT_ecc.append(np.ravel(im_eccentricity)[idx_closest])
-                    else:  # multi-frame
-                        AFT_angle.append(np.ravel(im_theta[time_point])[idx_closest])
-                        AFT_ecc.append(np.ravel(im_eccentricity[time_point])[idx_closest])
-                elif isinstance(im_theta, list): #why did I write this block???? 
-                    frame_theta = im_theta[time_point]
-                    frame_ecc = im_eccentricity[time_point]
-                    AFT_angle.append(np.ravel(frame_theta)[idx_closest])
-                    AFT_ecc.append(np.ravel(frame_ecc)[idx_closest])
-
-
-                # Track angle
-                dx, dy = track_next[0]-track_current[0], track_next[1]-track_current[1]
-                norm = np.sqrt(dx**2 + dy**2)
-                track_angle.append(np.arctan2(dy/norm, dx/norm))
-                current_time_point.append(df_track.loc[time_point, 'FRAME'])
-
-            # Calculate alignment metrics
-            AFT_angle = np.array(AFT_angle)
-            AFT_ecc = np.array(AFT_ecc)
-            track_angle = np.array(track_angle)
-            current_time_point = np.array(current_time_point)
-            ECM_nearest = np.array(ECM_nearest)
-            
-            AFT_track_angle = AFT_angle - track_angle
-            AFT_track_angle_cos2 = np.cos(AFT_track_angle)**2
-
-            # Build output DataFrame
-            df_out = pd.DataFrame({
-                'TRACK_ID': trackID,
-                'FRAME': current_time_point,
-                'image_name': im_list_current[position],
-                'ECM_x': ECM_x,
-                'ECM_y': ECM_y,
-                'track_angle': track_angle,
-                'AFT_angle': AFT_angle,
-                'AFT-Δφ': AFT_track_angle,
-                'AFT-AI': AFT_track_angle_cos2,
-                'AFT_eccentricity': AFT_ecc,
-                'track_angle_u': np.cos(track_angle),
-                'track_angle_v': np.sin(track_angle),
-                'AFT_angle_u': np.cos(AFT_angle),
-                'AFT_angle_v': np.sin(AFT_angle)
-            })
+        # Run AFT on image
+        if sparse:
+            # (frame, x, y) of every track position that gets an AFT angle below
+            df_tracks, current, time_point = track_steps(df_subset)
+            queries = np.column_stack((
+                time_point if im.ndim == 3 else np.zeros_like(time_point),
+                df_tracks['POSITION_X'].to_numpy()[current],
+                df_tracks['POSITION_Y'].to_numpy()[current]
+            ))
+            x, y, u, v, im_theta, im_eccentricity = AFT.sparse_local_order(
+                im, queries, window_size, overlap,
+                im_mask, intensity_thresh, eccentricity_thresh,
+                cache=sparse_cache
+            )
+        else:
+            x, y, u, v, im_theta, im_eccentricity = AFT.image_local_order(
+                im, window_size, overlap,
+                im_mask, intensity_thresh, eccentricity_thresh,
+                plot_overlay=False, plot_angles=False, plot_eccentricity=False,
+                save_figures=False, save_path='', cache_dir=cache_dir
+            )
 
-            df_track_for_merge = df_track.loc[df_track['FRAME'].isin(df_out['FRAME'])]
-            df_out_merge = pd.merge(df_track_for_merge, df_out, on=['TRACK_ID','FRAME'], how='inner')
-            
-            df_track_out = pd.concat([df_track_out, df_out_merge], ignore_index=True)
+        df_track_out = track_alignment(df_subset, im_list_current[position], x, y, im_theta, im_eccentricity)
 
-        df_subset_out = pd.concat([df_subset_out, df_track_out], ignore_index=True)
+        image_tables.append(df_track_out)
         print(f"Image {position}: df_subset shape = {df_subset.shape}, frames = {df_subset['FRAME'].nunique()}")
 
-    return df_subset_out
+    return pd.concat(image_tables, ignore_index=True)
+
+def local_order_values(x, y, im_theta, neighborhood_radius):
+    # window positions and local order parameter of every window of one image
+    # (the neighborhood, window included, is summed from summed-area tables of cos2θ and sin2θ, leaving out NaN angles;
+    # NaN for windows without a full neighborhood or without an angle)
+    theta = np.array(im_theta) #extract theta
+    order_value = AFT.order_parameter_field(AFT.order_parameter_tables(theta), neighborhood_radius, include_center=True)
+
+    return np.asarray(x, dtype='float64'), np.asarray(y, dtype='float64'), order_value.ravel()
+
+def order_parameter_dataframe(labels, image_values, window_size, overlap, neighborhood_radius):
+    """
+    Build the local order table of all images at once.
+
+    Parameters:
+    -----------
+    labels : list of str
+        Name of every image.
+    image_values : list of tuple
+        Output of local_order_values for every image.
+    window_size, overlap, neighborhood_radius :
+        AFT parameters, stored in df.attrs instead of a column.
+
+    Returns:
+    --------
+    df : pd.DataFrame
+        One row per window, image_name and ECM_ID are categorical.
+    """
+    n_windows = [len(order_value) for ECM_x, ECM_y, order_value in image_values]
+    ECM_x, ECM_y, order_value = (np.concatenate([np.empty(0)] + [values[i] for values in image_values]) for i in range(3))
+
+    df = pd.DataFrame({
+        'image_name': pd.Categorical(np.repeat(np.asarray(labels, dtype=object), n_windows), categories=pd.unique(np.asarray(labels, dtype=object))),
+        'ECM_ID': pd.Categorical.from_codes(np.concatenate([np.arange(n) for n in [0] + n_windows]),
+                                            categories=[f"ECM_{i+1}" for i in range(max(n_windows, default=0))]),
+        'ECM_x': ECM_x,
+        'ECM_y': ECM_y,
+        'order_value': order_value
+    })
+    # the same for every row
+    df.attrs.update(window_size=window_size, overlap=overlap, neighborhood_radius=neighborhood_radius)
+
+    return df
 
 def AFT_order_parameter(im_list, window_size, overlap,
                         im_mask, intensity_thresh, eccentricity_thresh,
-                        neighborhood_radius, single_frame, save_path=''):
+                        neighborhood_radius, single_frame, save_path='', cache_dir=None):
 
-    records = [] #create empty list for records
+    labels, image_values = [], [] #create empty lists for the names and values of every image
 
     #read image
     for im_file in im_list:
@@ -181,54 +276,15 @@ def AFT_order_parameter(im_list, window_size, overlap,
         #Run AFT on image
         x, y, u, v, im_theta, im_ecc = AFT.image_local_order(im, window_size=window_size, overlap=overlap, im_mask=im_mask,
             intensity_thresh=intensity_thresh, eccentricity_thresh=eccentricity_thresh, plot_overlay=False, plot_angles=False,
-            plot_eccentricity=False, save_figures=False, save_path=save_path
+            plot_eccentricity=False, save_figures=False, save_path=save_path, cache_dir=cache_dir
             )
 
-        x = np.array(x) #extract x patch coords
-        y = np.array(y) #extract y patch coords
-        theta = np.array(im_theta) #extract theta 
-
-        nrows, ncols = theta.shape #extract patch number as N patches in rows and N patches in columns
-
-        for idx in range(len(x)): #go through the pathes indexes (go in x axis)
-            r = idx // ncols #which column of the patch 
-            c = idx % ncols #which row of the patch
-            
-            #NaN all pathes that are nearby the border and don't have a full neighboor 
-            if r - neighborhood_radius < 0 or c - neighborhood_radius < 0 or r + neighborhood_radius >= nrows or c + neighborhood_radius >= ncols:
-                order_val = np.nan
-            #if have a full neighboorhood
-            else:
-                ref = theta[r, c] #take theta in patch centre 
-                if np.isnan(ref): #if theta Nan order value is also NaN
-                    order_val = np.nan
-                else:
-                    #take the neighboor theta values
-                    patch = theta[r-neighborhood_radius:r+neighborhood_radius+1, c-neighborhood_radius:c+neighborhood_radius+1]
-                    #calculate delta between neighbors and the central patch
-                    delta = patch - ref 
-                    #### copy calculation from AFT_tools.py, but for local ECM patch
-
-                    #take the mean of cos(delta) as order value for the patch in the center of the neighborhood
-                    order_array = np.cos(delta)**2 - 0.5
-                    #take the mean of cos(delta) as order value for the patch in the center of the neighborhood
-                    order_val = float(2 * np.nanmean(order_array))
-                    
-
-            records.append({
-                "image_name": label,
-                "ECM_ID": f"ECM_{idx+1}",
-                "ECM_x": float(x[idx]),
-                "ECM_y": float(y[idx]),
-                "order_value": order_val,
-                "window_size": window_size,
-                "overlap": overlap,
-                "neighborhood_radius": neighborhood_radius
-            })
+        labels.append(label)
+        image_values.append(local_order_values(x, y, im_theta, neighborhood_radius))
 
         print(f"Processed {filename}")
 
-    return pd.DataFrame(records)
+    return order_parameter_dataframe(labels, image_values, window_size, overlap, neighborhood_radius)
 
 # transfer intensity calculation to segmentation pipeline?
 
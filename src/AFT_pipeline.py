@@ -0,0 +1,129 @@
+import os
+import pandas as pd
+from skimage import img_as_float, io
+import AFT_tools as AFT
+import AFT_metrics
+import AFT_figures
+
+def AFT_pipeline(im_list, window_size, overlap,
+                 im_mask=None, intensity_thresh=0, eccentricity_thresh=0,
+                 single_frame=False, df_spots=None, neighborhood_radius=None,
+                 segmentation_parameters=None, overlay_parameters=None,
+                 n_workers=1, cache_dir=None):
+    """
+    Read every image once, run AFT on it once and compute the selected metrics from that field.
+
+    A metric is computed when its inputs are given. The output DataFrames are
+    the same as the ones of AFT_metrics.AFT_AI_metric,
+    AFT_metrics.AFT_order_parameter and segmentation.segmentation_features.
+
+    Parameters
+    ----------
+    im_list : list of str
+        List of file paths to images.
+    window_size : int
+        Window size for AFT analysis.
+    overlap : float
+        Overlap between windows.
+    im_mask : np.array, optional
+        Mask for AFT analysis (default: None).
+    intensity_thresh : float, optional
+        Intensity threshold for AFT (default: 0).
+    eccentricity_thresh : float, optional
+        Eccentricity threshold for AFT (default: 0).
+    single_frame : bool, optional
+        Whether images are single-frame (default: False).
+    df_spots : pd.DataFrame, optional
+        Spot positions and tracks, to calculate the track alignment (AFT-AI).
+    neighborhood_radius : int, optional
+        Neighborhood radius, to calculate the local order parameter.
+    segmentation_parameters : dict, optional
+        Keyword arguments of segmentation.segmentation_features besides the
+        AFT parameters (windows_curvature, intensity_clip_percent,
+        minLineWidth, maxLineWidth, minimumBranchLength, do_skeleton,
+        do_enhance_contrast, prune_short, contrastLow, contrastHigh,
+        darkline and optionally ridge_engine), to calculate the segmentation
+        features. The segmentation module needs the fractal package
+        (https://github.com/wanglab-georgetown/fractal), it is only imported
+        when these are given.
+    overlay_parameters : dict, optional
+        px_size_x, px_size_y and output_image_folder of
+        AFT_figures.plot_AFT_overlays, to save the overlays (needs df_spots).
+    n_workers : int, optional
+        Number of threads for AFT and the line widths of the ridge detection
+        (default: 1).
+    cache_dir : str, optional
+        Folder of cached AFT orientation fields (default: None).
+
+    Returns
+    -------
+    df_subset_out : pd.DataFrame or None
+        Track-AFT alignment metrics for all images.
+    df_order : pd.DataFrame or None
+        Local order parameter of every window of all images.
+    df_features : pd.DataFrame or None
+        Segmentation features of every window of all images.
+    """
+    if overlay_parameters is not None and df_spots is None:
+        raise ValueError("The overlays need the tracks, give df_spots")
+    if segmentation_parameters is not None:
+        # needs the fractal package, which the other metrics don't
+        import segmentation
+
+    alignment_tables = [pd.DataFrame()] if df_spots is not None else None
+    order_labels, order_values = [], []
+    feature_records = [] if segmentation_parameters is not None else None
+
+    for im_file in im_list:
+        # extract the name of the image as it is in the spot table
+        filename = os.path.basename(im_file)
+        label = filename.replace('.tif', '')
+
+        # read the image once
+        im_raw = io.imread(im_file)
+        im = im_raw[0,] if im_raw.ndim == 3 and single_frame else im_raw #take only first frame if single frame
+
+        # run AFT once
+        x, y, u, v, im_theta, im_eccentricity = AFT.image_local_order(
+            im, window_size, overlap,
+            im_mask, intensity_thresh, eccentricity_thresh,
+            plot_overlay=False, plot_angles=False, plot_eccentricity=False,
+            save_figures=False, save_path='', n_workers=n_workers, cache_dir=cache_dir
+        )
+
+        # track alignment
+        if df_spots is not None:
+            df_subset = df_spots.loc[df_spots.File_name_raw == label]
+            df_track_out = AFT_metrics.track_alignment(df_subset, label, x, y, im_theta, im_eccentricity)
+            alignment_tables.append(df_track_out)
+
+            # overlays of the tracks of this image
+            if overlay_parameters is not None:
+                AFT_figures.plot_image_AFT_overlays(
+                    im, x, y, u, v, df_track_out, label, overlap, single_frame,
+                    overlay_parameters['px_size_x'], overlay_parameters['px_size_y'],
+                    overlay_parameters['output_image_folder']
+                )
+
+        # local order parameter
+        if neighborhood_radius is not None:
+            order_labels.append(label)
+            order_values.append(AFT_metrics.local_order_values(x, y, im_theta, neighborhood_radius))
+
+        # segmentation features (on the first frame, only the window grid of AFT is used)
+        if segmentation_parameters is not None:
+            im_segmentation = img_as_float(im_raw[0] if im_raw.ndim == 3 else im_raw)
+            feature_records.extend(segmentation.image_segmentation_features(
+                im_segmentation, label, x, y, window_size=window_size, im_mask=im_mask, n_workers=n_workers,
+                **segmentation_parameters
+            ))
+
+        print(f"Processed {filename}")
+
+    df_subset_out = pd.concat(alignment_tables, ignore_index=True) if alignment_tables is not None else None
+    df_order = None
+    if neighborhood_radius is not None:
+        df_order = AFT_metrics.order_parameter_dataframe(order_labels, order_values, window_size, overlap, neighborhood_radius)
+    df_features = pd.DataFrame(feature_records) if feature_records is not None else None
+
+    return df_subset_out, df_order, df_features
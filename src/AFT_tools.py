@@ -1,46 +1,124 @@
 import numpy as np
-from scipy.fft import fft2, fftshift, ifft2, ifftshift, fft, ifft, fftfreq
+from scipy.fft import fft2, fftshift, ifft2, ifftshift, fft, ifft, fftfreq, rfft2
 import skimage.io as io
+import tifffile
 import cv2                                                     # for filtering vector fields
 from skimage.morphology import disk        # morphology operations
-import numpy.matlib as matlib
 import matplotlib.pyplot as plt
 import pandas as pd
-from scipy.stats import mannwhitneyu
+from scipy.stats import mannwhitneyu, spearmanr, rankdata
 import os
+import hashlib
+import zipfile
+from functools import lru_cache, partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from collections import deque, OrderedDict
+from itertools import chain, repeat
+from scipy import spatial
 
 
 def image_norm(im):
     im_norm = np.sqrt(np.real(im * np.conj(im)))
     return im_norm
 
+@lru_cache(maxsize=None)
+def periodic_kernel(N_rows, N_cols, dtype='float64'):
+    # calculate the frequencies of the image
+    fx = np.tile(np.cos(2 * np.pi * np.arange(0,N_cols) / N_cols), (N_rows,1))
+    fy = np.tile(np.cos(2 * np.pi * np.arange(0,N_rows) / N_rows), (N_cols,1)).T
+    # set the fx[0,0] to 0 to avoid division by zero
+    fx[0,0] = 0
+    # the kernel is shared between calls, so make sure it can't be modified in place
+    kernel = (0.5 / (2 - fx - fy)).astype(dtype)
+    kernel.flags.writeable = False
+    return kernel
+
 def periodic_decomposition(im):
     im = im.astype('float32')
-    # find the number of rows and cols
-    N_rows, N_cols = im.shape
+    # find the number of rows and cols (the last two axes, so a stack of windows works too)
+    N_rows, N_cols = im.shape[-2:]
     # create an zero matrix the size of the image
-    v = np.zeros((N_rows,N_cols))
+    v = np.zeros(im.shape)
     # fill the edges of V with the difference between the opposite edge of the real image
-    v[0,:] = im[0,:] - im[-1,:]
-    v[-1,:] = -v[0,:]
-    v[:,0] = v[:,0] + im[:,0] - im[:,-1]
-    v[:,-1] = v[:,-1] - im[:,0] + im[:,-1]
-    # calculate the frequencies of the image
-    fx = matlib.repmat(np.cos(2 * np.pi * np.arange(0,N_cols) / N_cols),N_rows,1)
-    fy = matlib.repmat(np.cos(2 * np.pi * np.arange(0,N_rows) / N_rows),N_cols,1).T
-    # set the fx[0,0] to 0 to avoid division by zero
-    fx[0,0] = 0
-    # calculate the smoothed image component
-    s = np.real(ifft2(fft2(v) * 0.5 / (2 - fx - fy)))
-    # If you want to calculate the periodic fft directly
-    # p_fft = fftshift(fft2(actin) - fft2(v) * 0.5 / (2 - fx - fy))
+    v[..., 0, :] = im[..., 0, :] - im[..., -1, :]
+    v[..., -1, :] = -v[..., 0, :]
+    v[..., :, 0] = v[..., :, 0] + im[..., :, 0] - im[..., :, -1]
+    v[..., :, -1] = v[..., :, -1] - im[..., :, 0] + im[..., :, -1]
+    # calculate the smoothed image component with the cached kernel for this window shape
+    s = np.real(ifft2(fft2(v) * periodic_kernel(N_rows, N_cols)))
+    # If you want to calculate the periodic fft directly, use periodic_spectrum
     p = im - s
 
     return p, s
 
+def periodic_edge_fft(im, N_freq_cols, workers=None):
+    # find the number of rows and cols (the last two axes, so a stack of windows works too)
+    N_rows, N_cols = im.shape[-2:]
+    # V (see periodic_decomposition) is only non-zero on its edges, so its FFT is the sum of
+    # the 1D FFTs of the edge differences times the phase factor of the opposite edge
+    row_diff = fft(im[..., 0, :] - im[..., -1, :], axis=-1, workers=workers)[..., :N_freq_cols]
+    col_diff = fft(im[..., :, 0] - im[..., :, -1], axis=-1, workers=workers)
+    row_phase = 1 - np.exp(2j * np.pi * np.arange(0,N_rows) / N_rows)
+    col_phase = 1 - np.exp(2j * np.pi * np.arange(0,N_freq_cols) / N_cols)
+    v_fft = row_phase[:, np.newaxis] * row_diff[..., np.newaxis, :] + col_diff[..., :, np.newaxis] * col_phase
+
+    return v_fft
+
+def periodic_spectrum(im, workers=None):
+    # same rounding of the image as periodic_decomposition, but transform in double precision
+    im = im.astype('float32').astype('float64')
+    N_rows, N_cols = im.shape[-2:]
+    # fft of the periodic component: fft2(im) - fft2(v) * kernel
+    p_fft = fft2(im, workers=workers) - periodic_edge_fft(im, N_cols, workers) * periodic_kernel(N_rows, N_cols)
+    # shift the zero frequency to the center and take the norm
+    p_fft_norm = image_norm(fftshift(p_fft, axes=(-2, -1)))
+
+    return p_fft_norm
+
+def periodic_half_spectrum(im, workers=None):
+    # same as periodic_spectrum, but only the non-negative column frequencies of the real FFT (not shifted)
+    im = im.astype('float32').astype('float64')
+    N_rows, N_cols = im.shape[-2:]
+    N_freq_cols = N_cols // 2 + 1
+    p_fft = rfft2(im, workers=workers) - periodic_edge_fft(im, N_freq_cols, workers) * periodic_kernel(N_rows, N_cols)[:, :N_freq_cols]
+    p_fft_norm = image_norm(p_fft)
+
+    return p_fft_norm
+
+def half_spectrum_weights(window_mask, xcoords, ycoords):
+    # get the window shape
+    N_rows, N_cols = window_mask.shape
+    N_freq_cols = N_cols // 2 + 1
+
+    # coordinate weights of the M00, M10, M01, M11, M20 and M02 moments within the mask
+    weights = np.stack([np.ones((N_rows, N_cols)), xcoords, ycoords, xcoords * ycoords, xcoords * xcoords, ycoords * ycoords])
+    weights = weights * window_mask
+    # undo the shift so the weights line up with the frequencies of the FFT
+    weights = ifftshift(weights, axes=(-2, -1))
+
+    # the norm of the spectrum of a real window is symmetric, |F(k,l)| = |F(-k,-l)|, so the
+    # weight of each mirrored frequency is folded onto the one kept by the real FFT
+    half_weights = weights[:, :, :N_freq_cols].copy()
+    mirrored = weights[:, (-np.arange(N_rows)) % N_rows][:, :, (-np.arange(N_freq_cols)) % N_cols]
+    # the zero (and Nyquist) column already holds both halves
+    col = np.arange(N_freq_cols)
+    paired = (col != 0) & (2 * col != N_cols)
+    half_weights[:, :, paired] += mirrored[:, :, paired]
+
+    return half_weights
+
+def moment_weight_matrix(window_mask, xcoords, ycoords):
+    # flatten the folded weights to one row per moment
+    half_weights = half_spectrum_weights(window_mask, xcoords, ycoords)
+    half_weights = half_weights.reshape(len(half_weights), -1)
+    # only the frequencies within the mask contribute to the moments (the M00 weight is the mask itself)
+    support = np.flatnonzero(half_weights[0])
+
+    return support, np.ascontiguousarray(half_weights[:, support].T)
+
 def least_moment(image, xcoords=[], ycoords=[]):
-    # get the image shape
-    N_rows, N_cols = image.shape
+    # get the image shape (the last two axes, so a stack of images gives one value per image)
+    N_rows, N_cols = image.shape[-2:]
 
     # check if xcoords and ycoords are passed in the function
     if len(xcoords) == 0:
@@ -48,13 +126,16 @@ def least_moment(image, xcoords=[], ycoords=[]):
         xcoords, ycoords = np.meshgrid(np.arange(0,N_cols) , np.arange(0,N_rows))
 
     #calculate the moments
-    M00 = np.sum(image)
-    M10 = np.sum(image * xcoords)
-    M01 = np.sum(image * ycoords)
-    M11 = np.sum(image * xcoords * ycoords)
-    M20 = np.sum(image * xcoords * xcoords)
-    M02 = np.sum(image * ycoords * ycoords)
+    M00 = np.sum(image, axis=(-2, -1))
+    M10 = np.sum(image * xcoords, axis=(-2, -1))
+    M01 = np.sum(image * ycoords, axis=(-2, -1))
+    M11 = np.sum(image * xcoords * ycoords, axis=(-2, -1))
+    M20 = np.sum(image * xcoords * xcoords, axis=(-2, -1))
+    M02 = np.sum(image * ycoords * ycoords, axis=(-2, -1))
 
+    return moment_orientation(M00, M10, M01, M11, M20, M02)
+
+def moment_orientation(M00, M10, M01, M11, M20, M02):
     # center of mass
     xave = M10 / M00
     yave = M01 / M00
@@ -79,8 +160,251 @@ def least_moment(image, xcoords=[], ycoords=[]):
 
     return theta, eccentricity
 
+def window_local_order(im_windows, moment_weights, fft_workers=None):
+    # take the FFT norm of the periodic component of every window in the (N, w, w) stack (half spectrum only)
+    im_windows_fft_norm = periodic_half_spectrum(im_windows, fft_workers)
+    # calculate all the moments of all the windows with one matrix multiply over the mask support
+    # (einsum rather than BLAS so each window gives the same bits whatever the size of its batch)
+    support, weight_matrix = moment_weights
+    im_windows_fft_norm = im_windows_fft_norm.reshape(len(im_windows_fft_norm), -1)[:, support]
+    moments = np.einsum('nk,km->nm', im_windows_fft_norm, weight_matrix)
+    # calculate the angle and eccentricity of orientation based on the FFT moments
+    theta, eccentricity = moment_orientation(*moments.T)
+
+    # correct for real space
+    theta = theta + np.pi/2
+
+    # map everything back to between -pi/2 and pi/2
+    theta = np.where(theta > np.pi/2, theta - np.pi, theta)
+
+    return theta, eccentricity
+
+def frame_local_order(im, frame_mask, rpos, cpos, radius, moment_weights,
+                      intensity_thresh=0, eccentricity_thresh=0, batch_size=1024, fft_workers=None, windows=None):
+    # windows that are not analysed stay NaN
+    im_theta = np.full((len(rpos), len(cpos)), np.nan)
+    im_ecc = np.full((len(rpos), len(cpos)), np.nan)
+
+    # grid positions of every window (or only the given row, col indices), keep only the ones within the image mask
+    if windows is None:
+        r_grid, c_grid = np.meshgrid(np.arange(len(rpos)), np.arange(len(cpos)), indexing='ij')
+        r_grid, c_grid = r_grid.ravel(), c_grid.ravel()
+    else:
+        r_grid, c_grid = np.asarray(windows[0]), np.asarray(windows[1])
+    if frame_mask is not None:
+        in_mask = frame_mask[rpos[r_grid], cpos[c_grid]]
+        r_grid, c_grid = r_grid[in_mask], c_grid[in_mask]
+    if len(r_grid) == 0:
+        return im_theta, im_ecc
+
+    # strided view of every window of the frame (no copy is made here)
+    window_view = np.lib.stride_tricks.sliding_window_view(im, (2 * radius + 1, 2 * radius + 1))
+
+    # analyse the windows in batches to bound the memory of the stacked FFTs
+    for start in range(0, len(r_grid), batch_size):
+        r_batch = r_grid[start:start + batch_size]
+        c_batch = c_grid[start:start + batch_size]
+        # gather the windows of the batch into one (N, w, w) array
+        im_windows = window_view[rpos[r_batch] - radius, cpos[c_batch] - radius]
+
+        # check that they are above the intensity threshold
+        above_thresh = np.mean(im_windows, axis=(-2, -1)) > intensity_thresh
+        if not np.any(above_thresh):
+            continue
+        r_batch, c_batch = r_batch[above_thresh], c_batch[above_thresh]
+
+        theta, eccentricity = window_local_order(im_windows[above_thresh], moment_weights, fft_workers)
+
+        # filter based on eccentricity
+        below_thresh = eccentricity < eccentricity_thresh
+        theta[below_thresh] = np.nan
+        eccentricity[below_thresh] = np.nan
+
+        im_theta[r_batch, c_batch] = theta
+        im_ecc[r_batch, c_batch] = eccentricity
+
+    return im_theta, im_ecc
+
+def gaussian_sampling_matrix(N, positions, sigma, truncate=4.0):
+    # rows of a Gaussian filter (scipy.ndimage 'reflect' edges) evaluated only at the given positions,
+    # so that filter @ image equals gaussian_filter1d(image, sigma, axis=0)[positions]
+    half_width = int(truncate * sigma + 0.5)
+    offsets = np.arange(-half_width, half_width + 1)
+    kernel = np.exp(-0.5 * (offsets / sigma)**2)
+    kernel = kernel / kernel.sum()
+
+    # reflect the indices that fall outside of the image
+    idx = positions[:, np.newaxis] + offsets
+    while np.any((idx < 0) | (idx >= N)):
+        idx = np.where(idx < 0, -idx - 1, idx)
+        idx = np.where(idx >= N, 2 * N - idx - 1, idx)
+
+    filter_matrix = np.zeros((len(positions), N))
+    np.add.at(filter_matrix, (np.repeat(np.arange(len(positions)), len(offsets)), idx.ravel()), np.tile(kernel, len(positions)))
+
+    return filter_matrix
+
+def structure_tensor_local_order(im, frame_mask, rpos, cpos, radius, intensity_thresh=0, eccentricity_thresh=0):
+    im = im.astype('float64')
+    # gradients of the image along the rows and cols (Sobel, smoothed across to reduce the noise)
+    grad_r = cv2.Sobel(im, cv2.CV_64F, 0, 1, ksize=3)
+    grad_c = cv2.Sobel(im, cv2.CV_64F, 1, 0, ksize=3)
+
+    # smooth the structure tensor over about the size of the window, only at the window positions
+    sigma = radius / 2
+    row_filter = gaussian_sampling_matrix(im.shape[0], rpos, sigma)
+    col_filter = gaussian_sampling_matrix(im.shape[1], cpos, sigma)
+    J_cc = row_filter @ (grad_c * grad_c) @ col_filter.T
+    J_rr = row_filter @ (grad_r * grad_r) @ col_filter.T
+    J_rc = row_filter @ (grad_r * grad_c) @ col_filter.T
+
+    # the fibres are perpendicular to the main gradient direction
+    theta = 0.5 * np.arctan2(2 * J_rc, J_cc - J_rr) + np.pi/2
+    # multiply by -1 to correct for origin being in top left corner (as in least_moment)
+    theta = -1 * theta
+    # map everything back to between -pi/2 and pi/2
+    theta = np.where(theta <= -np.pi/2, theta + np.pi, theta)
+
+    # the coherence stands in for the eccentricity (0 isotropic, 1 perfectly aligned)
+    coherence = np.sqrt((J_cc - J_rr)**2 + 4 * J_rc**2) / (J_cc + J_rr)
+
+    # windows outside the image mask or below the intensity threshold stay NaN
+    keep = cv2.blur(im, (2 * radius + 1, 2 * radius + 1))[np.ix_(rpos, cpos)] > intensity_thresh
+    if frame_mask is not None:
+        keep &= frame_mask[np.ix_(rpos, cpos)]
+    # filter based on the coherence
+    keep &= ~(coherence < eccentricity_thresh)
+    theta[~keep] = np.nan
+    coherence[~keep] = np.nan
+
+    return theta, coherence
+
+def window_moment_weights(window_size):
+    # define the radius of the window
+    radius = int(np.floor((window_size) / 2))
+
+    # make a structuring element to filter the mask
+    bpass_filter = disk(radius * .5)
+
+    # make window mask
+    window_mask = np.zeros((window_size, window_size))
+    window_mask[int(np.floor(window_size/2)), int(np.floor(window_size/2))] = 1
+
+    # filter the mask with the structuring element to define the ROI
+    window_mask = cv2.filter2D(window_mask, -1, bpass_filter)
+    window_mask = np.rint(window_mask) == 1
+
+    # make x and y coordinate matrices
+    xcoords, ycoords = np.meshgrid(np.arange(0,window_size) , np.arange(0,window_size))
+
+    # moment weights of the mask over the half spectrum of the real FFT
+    return moment_weight_matrix(window_mask, xcoords, ycoords)
+
+def image_hash(im):
+    # content hash of an image (values, shape and dtype)
+    im = np.ascontiguousarray(im)
+    return hashlib.sha1(str((im.shape, im.dtype.str)).encode() + im.tobytes()).hexdigest()
+
+def local_order_cache_key(imstack, im_mask, window_size, overlap, intensity_thresh, eccentricity_thresh, engine):
+    # the image hash and a hash of the mask and the parameters, a cached orientation is only reused when both match
+    mask_hash = 'none' if im_mask is None else image_hash(im_mask)
+    parameters = repr((mask_hash, window_size, overlap, intensity_thresh, eccentricity_thresh, engine))
+    return image_hash(imstack), hashlib.sha1(parameters.encode()).hexdigest()[:16]
+
+def local_order_cache_file(cache_dir, imstack, im_mask, window_size, overlap, intensity_thresh, eccentricity_thresh, engine):
+    # the file of an orientation field is named after the image hash and a hash of the mask and the parameters
+    return os.path.join(cache_dir, '%s_%s.npz' % local_order_cache_key(imstack, im_mask, window_size, overlap,
+                                                                      intensity_thresh, eccentricity_thresh, engine))
+
+def load_local_order_cache(cache_file):
+    # x, y, theta and eccentricity of an earlier run (None if it isn't cached or can't be read)
+    try:
+        with np.load(cache_file) as cached:
+            result = cached['x'], cached['y'], cached['theta'], cached['eccentricity']
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        return None
+    # mark the file as recently used
+    try:
+        os.utime(cache_file)
+    except OSError:
+        pass
+    return result
+
+def save_local_order_cache(cache_file, x, y, theta, eccentricity, cache_size):
+    # write to a temporary file first so other processes never read a half written file
+    os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+    temp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+    with open(temp_file, 'wb') as f:
+        np.savez_compressed(f, x=x, y=y, theta=theta, eccentricity=eccentricity)
+    os.replace(temp_file, cache_file)
+    evict_local_order_cache(os.path.dirname(cache_file) or '.', cache_size)
+
+def evict_local_order_cache(cache_dir, cache_size):
+    # remove the least recently used orientation fields until the cache is at most cache_size bytes
+    if cache_size is None:
+        return
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.npz'):
+            try:
+                stat = os.stat(os.path.join(cache_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= cache_size:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def clear_local_order_cache(cache_dir, imstack=None):
+    # remove the cached orientation fields of an image (or of all images)
+    if not os.path.isdir(cache_dir):
+        return
+    if imstack is not None:
+        # single images are cached as a stack of one frame
+        if imstack.ndim == 2:
+            imstack = np.expand_dims(imstack, axis=0)
+        prefix = image_hash(imstack) + '_'
+    for name in os.listdir(cache_dir):
+        if name.endswith('.npz') and (imstack is None or name.startswith(prefix)):
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except FileNotFoundError:
+                pass
+
+def window_grid(shape, window_size, overlap):
+    # the window grid of an image of this shape, the same for image_local_order, iter_image_local_order,
+    # sparse_local_order and image_local_order_tiled
+    N_rows, N_cols = shape[-2:]
+
+    # make window size odd if it isn't already
+    if window_size % 2 == 0:
+        window_size += 1
+
+    # define the radius of the window
+    radius = int(np.floor((window_size) / 2))
+
+    # make a list of the r,c positions for the windows
+    step = int(window_size * overlap)
+    rpos = np.arange(radius,N_rows-radius,step)
+    cpos = np.arange(radius,N_cols-radius,step)
+
+    return window_size, radius, rpos, cpos
+
+def executor_workers(executor, n_workers):
+    # number of workers to keep busy, a given executor sets it instead of n_workers
+    if executor is None:
+        return n_workers
+    return getattr(executor, '_max_workers', n_workers)
+
 def image_local_order(imstack, window_size = 33, overlap = 0.5, im_mask = None, intensity_thresh = 0, eccentricity_thresh = 0, 
-                        plot_overlay=False, plot_angles=False, plot_eccentricity=False, save_figures=False, save_path = ''):
+                        plot_overlay=False, plot_angles=False, plot_eccentricity=False, save_figures=False, save_path = '',
+                        n_workers=1, executor=None, fft_workers=None, engine='fft', cache_dir=None, cache_size=2**30):
     
     # check if an output directory is given
     if len(save_path) > 0:
@@ -98,109 +422,87 @@ def image_local_order(imstack, window_size = 33, overlap = 0.5, im_mask = None,
     # get the image shape
     N_images, N_rows, N_cols = imstack.shape
 
-    # make window size off if it isn't already
-    if window_size % 2 == 0:
-        window_size += 1
-    
-    # define the radius of the window
-    radius = int(np.floor((window_size) / 2))
-    
-    # make a list of the r,c positions for the windows
-    rpos = np.arange(radius,N_rows-radius,int(window_size * overlap))
-    cpos = np.arange(radius,N_cols-radius,int(window_size * overlap))
-
-    # make a structuring element to filter the mask
-    bpass_filter = disk(radius * .5)
-
-    # make window mask
-    window_mask = np.zeros((window_size, window_size))
-    window_mask[int(np.floor(window_size/2)), int(np.floor(window_size/2))] = 1
-
-    # filter the mask with the structuring element to define the ROI
-    window_mask = cv2.filter2D(window_mask, -1, bpass_filter)
-    window_mask = np.rint(window_mask) == 1
+    # odd window size, radius and r,c positions of the windows
+    window_size, radius, rpos, cpos = window_grid(imstack.shape, window_size, overlap)
 
-    # check if there is an image mask
-    if im_mask is None:
-        im_mask = np.ones_like(imstack).astype('bool')
-    else:
+    # check if there is an image mask (without one every window is analysed)
+    if im_mask is not None:
         # make sure the input mask is a boolean
         im_mask = im_mask.astype('bool')
 
-    # make x and y coordinate matrices
-    xcoords, ycoords = np.meshgrid(np.arange(0,window_size) , np.arange(0,window_size))
-
     # length of orientation vector
     arrow_length = radius / 2
 
     # make lists to hold for multiple frames
     theta_stack, ecc_stack, u_stack, v_stack = [], [], [], []
 
+    # look for the orientation field of this image and these parameters from an earlier run
+    cached = None
+    if cache_dir is not None:
+        cache_file = local_order_cache_file(cache_dir, imstack, im_mask, window_size, overlap, intensity_thresh, eccentricity_thresh, engine)
+        cached = load_local_order_cache(cache_file)
+
+    if cached is not None:
+        x, y, frame_thetas, frame_eccs = cached
+    else:
+        # moment weights of the band pass mask of the window
+        moment_weights = window_moment_weights(window_size)
+
+        # split the frames into row bands of windows when there are more workers than frames
+        # (the structure tensor is filtered over the whole frame, so it isn't split)
+        n_bands = max(1, executor_workers(executor, n_workers) // N_images) if engine == 'fft' else 1
+        bands = [band for band in np.array_split(rpos, n_bands) if len(band) > 0]
+        # crop the rows (plus the window radius) of every band, only the crop is sent to a worker
+        # (the structure tensor gets the whole frame, its Gaussian filter reaches past the window radius)
+        if engine == 'fft':
+            crops = [(frame, band, band[0] - radius, band[-1] + radius + 1) for frame in range(N_images) for band in bands]
+        else:
+            crops = [(frame, band, 0, N_rows) for frame in range(N_images) for band in bands]
+        band_images = [imstack[frame, top:bottom] for frame, band, top, bottom in crops]
+        band_masks = [None if im_mask is None else im_mask[frame, top:bottom] for frame, band, top, bottom in crops]
+        band_rpos = [band - top for frame, band, top, bottom in crops]
+        if engine == 'fft':
+            band_local_order = partial(frame_local_order, cpos=cpos, radius=radius, moment_weights=moment_weights,
+                                       intensity_thresh=intensity_thresh, eccentricity_thresh=eccentricity_thresh,
+                                       fft_workers=fft_workers)
+        elif engine == 'structure_tensor':
+            band_local_order = partial(structure_tensor_local_order, cpos=cpos, radius=radius,
+                                       intensity_thresh=intensity_thresh, eccentricity_thresh=eccentricity_thresh)
+        else:
+            raise ValueError(f"Unknown engine '{engine}', use 'fft' or 'structure_tensor'")
+
+        # measure the local orientation of every band, in order, on the executor if there is one
+        if executor is not None:
+            band_results = list(executor.map(band_local_order, band_images, band_masks, band_rpos))
+        elif n_workers > 1:
+            with ThreadPoolExecutor(max_workers=n_workers) as pool:
+                band_results = list(pool.map(band_local_order, band_images, band_masks, band_rpos))
+        else:
+            band_results = list(map(band_local_order, band_images, band_masks, band_rpos))
+
+        # stitch the bands of every frame back together
+        frame_thetas, frame_eccs = [], []
+        for frame in range(N_images):
+            frame_results = band_results[frame * len(bands):(frame + 1) * len(bands)]
+            frame_thetas.append(np.concatenate([theta for theta, ecc in frame_results]) if bands else np.full((0, len(cpos)), np.nan))
+            frame_eccs.append(np.concatenate([ecc for theta, ecc in frame_results]) if bands else np.full((0, len(cpos)), np.nan))
+
+        # store the row and column positions
+        x = np.tile(cpos, len(rpos))
+        y = np.repeat(rpos, len(cpos))
+
+        if cache_dir is not None:
+            save_local_order_cache(cache_file, x, y, np.stack(frame_thetas), np.stack(frame_eccs), cache_size)
+
     for frame,im in enumerate(imstack):
 
-        # make empty list variables
-        im_theta, im_ecc = [], []
-        x, y, u, v = [], [], [], []
-        
-        
-        # loop through each position and measure the local orientation
-        for r in rpos:
-            for c in cpos:
-                # store the row and column positions
-                x.append(c)
-                y.append(r)
-
-                # check to see if point is within image mask
-                if im_mask[frame,r,c] == True:
-                    # define the window to analyze
-                    im_window = im[r-radius:r+radius+1,c-radius:c+radius+1]
-
-                    # check that it's above the intensity threshold
-                    if np.mean(im_window) > intensity_thresh:
-                        # separate out the periodic and smooth components
-                        im_window_periodic, im_window_smooth = periodic_decomposition(im_window)
-                        # take the FFT of the periodic component
-                        im_window_fft = fftshift(fft2(im_window_periodic))
-                        # find the image norm and mulitply by the mask
-                        im_window_fft_norm = image_norm(im_window_fft) * window_mask
-                        # calculate the angle and eccentricity of orientation based on the FFT moments
-                        theta, eccentricity = least_moment(im_window_fft_norm, xcoords, ycoords)
-
-                        # correct for real space
-                        theta = theta + np.pi/2
-
-                        # map everything back to between -pi/2 and pi/2
-                        if theta > np.pi/2:
-                            theta -= np.pi
-
-                        # filter based on eccentricity
-                        if eccentricity < eccentricity_thresh:
-                            eccentricity = np.nan
-                            theta = np.nan
-
-                        # add the values to each list
-                        im_theta.append(theta)
-                        im_ecc.append(eccentricity)
-                        u.append(np.cos(theta) * arrow_length)
-                        v.append(np.sin(theta) * arrow_length)
-                    else:
-                        im_theta.append(np.nan)
-                        im_ecc.append(np.nan)
-                        u.append(np.nan)
-                        v.append(np.nan)
-                else:
-                    im_theta.append(np.nan)
-                    im_ecc.append(np.nan)
-                    u.append(np.nan)
-                    v.append(np.nan)
-
-        # turn all the lists into arrays for simple indexing
-        x = np.array(x)
-        y = np.array(y)
-        u = np.array(u)
-        v = np.array(v)
-        im_theta = np.reshape(im_theta,(len(rpos),len(cpos)))
-        im_ecc = np.reshape(im_ecc,(len(rpos),len(cpos)))
+        # orientation and eccentricity of the frame
+        im_theta = frame_thetas[frame]
+        im_ecc = frame_eccs[frame]
+
+        # length of the orientation vectors (NaN where there is no orientation)
+        u = np.cos(im_theta.ravel()) * arrow_length
+        v = np.sin(im_theta.ravel()) * arrow_length
 
         if plot_angles:
             plt.figure()
@@ -244,7 +546,315 @@ def image_local_order(imstack, window_size = 33, overlap = 0.5, im_mask = None,
     return x, y, u_stack, v_stack, theta_stack, ecc_stack
 
 
-def calculate_order_parameter(im_theta_stack, neighborhood_radius):
+def iter_frames(image_path):
+    # read the frames of a (multi-page) tiff one at a time
+    with tifffile.TiffFile(image_path) as tif:
+        for page in tif.pages:
+            yield page.asarray()
+
+def iter_image_local_order(frames, window_size = 33, overlap = 0.5, im_mask = None, intensity_thresh = 0, eccentricity_thresh = 0,
+                           n_workers = 1, executor = None, fft_workers = None):
+    # a path is read lazily frame by frame, a single image is a stack of one frame
+    if isinstance(frames, str):
+        frames = iter_frames(frames)
+    elif isinstance(frames, np.ndarray) and frames.ndim == 2:
+        frames = [frames]
+
+    # odd window size and radius (the r,c positions of the windows depend on the shape of each frame)
+    window_size, radius, _, _ = window_grid((0, 0), window_size, overlap)
+
+    # length of orientation vector
+    arrow_length = radius / 2
+
+    # moment weights of the band pass mask of the window
+    moment_weights = window_moment_weights(window_size)
+
+    frame_order = partial(frame_local_order, radius=radius, moment_weights=moment_weights,
+                          intensity_thresh=intensity_thresh, eccentricity_thresh=eccentricity_thresh,
+                          fft_workers=fft_workers)
+
+    pool = executor
+    if pool is None and n_workers > 1:
+        pool = ThreadPoolExecutor(max_workers=n_workers)
+
+    def submit(frame, im):
+        # r,c positions of the windows (same grid as image_local_order)
+        _, _, rpos, cpos = window_grid(im.shape, window_size, overlap)
+        # a 2D mask is used for every frame, a stack of masks is indexed by frame
+        if im_mask is None:
+            frame_mask = None
+        elif im_mask.ndim == 2:
+            frame_mask = im_mask.astype('bool')
+        else:
+            frame_mask = im_mask[frame].astype('bool')
+        if pool is None:
+            return rpos, cpos, frame_order(im, frame_mask, rpos, cpos)
+        return rpos, cpos, pool.submit(frame_order, im, frame_mask, rpos, cpos)
+
+    # keep a few frames per worker (of the executor, if one is given) in flight ahead of the one being yielded,
+    # so memory stays flat
+    n_ahead = 2 * max(1, executor_workers(executor, n_workers))
+    try:
+        pending = deque()
+        for frame, im in enumerate(frames):
+            pending.append(submit(frame, im))
+            if len(pending) <= n_ahead and pool is not None:
+                continue
+            yield frame_output(*pending.popleft(), arrow_length)
+        while pending:
+            yield frame_output(*pending.popleft(), arrow_length)
+    finally:
+        if executor is None and pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+def frame_output(rpos, cpos, result, arrow_length):
+    # wait for the frame if it runs on a worker
+    im_theta, im_ecc = result.result() if isinstance(result, Future) else result
+
+    # store the row and column positions
+    x = np.tile(cpos, len(rpos))
+    y = np.repeat(rpos, len(cpos))
+    # length of the orientation vectors (NaN where there is no orientation)
+    u = np.cos(im_theta.ravel()) * arrow_length
+    v = np.sin(im_theta.ravel()) * arrow_length
+
+    return x, y, u, v, im_theta, im_ecc
+
+def nearest_window(x, y, points):
+    # index of the window closest to every (x, y) point, one tree for all the points
+    d_closest, idx_closest = spatial.KDTree(np.column_stack((x, y))).query(points)
+    return idx_closest
+
+def sparse_local_order(imstack, queries, window_size = 33, overlap = 0.5, im_mask = None, intensity_thresh = 0, eccentricity_thresh = 0,
+                       cache = None, cache_size = 100000, fft_workers = None):
+    # check to see if it's a stack of images or a single image
+    if len(imstack.shape) == 2:
+        imstack = np.expand_dims(imstack, axis=0)
+    if im_mask is not None:
+        if len(im_mask.shape) == 2:
+            im_mask = np.expand_dims(im_mask, axis=0)
+        # make sure the input mask is a boolean
+        im_mask = im_mask.astype('bool')
+
+    # get the image shape
+    N_images, N_rows, N_cols = imstack.shape
+
+    # odd window size, radius and r,c positions of the windows (same grid as image_local_order)
+    window_size, radius, rpos, cpos = window_grid(imstack.shape, window_size, overlap)
+    x = np.tile(cpos, len(rpos))
+    y = np.repeat(rpos, len(cpos))
+
+    # length of orientation vector
+    arrow_length = radius / 2
+
+    # the windows that aren't needed by any (frame, x, y) query stay NaN
+    theta_stack = np.full((N_images, len(rpos), len(cpos)), np.nan)
+    ecc_stack = np.full((N_images, len(rpos), len(cpos)), np.nan)
+
+    # LRU cache of the windows computed so far, keyed by the image and parameter hashes and (frame, row, col) of the grid,
+    # so one cache can be passed to calls with different images and parameters
+    if cache is None:
+        cache = OrderedDict()
+
+    queries = np.asarray(queries, dtype='float64').reshape(-1, 3)
+    if len(queries) > 0 and len(x) > 0:
+        # find the window each query falls in
+        frames = queries[:, 0].astype(int)
+        r_idx, c_idx = np.divmod(nearest_window(x, y, queries[:, 1:]), len(cpos))
+        windows = set(zip(frames.tolist(), r_idx.tolist(), c_idx.tolist()))
+
+        # take the windows that were already computed from the cache
+        cache_key = local_order_cache_key(imstack, im_mask, window_size, overlap, intensity_thresh, eccentricity_thresh, 'fft')
+        missing = []
+        for key in windows:
+            if cache_key + key in cache:
+                cache.move_to_end(cache_key + key)
+                theta_stack[key], ecc_stack[key] = cache[cache_key + key]
+            else:
+                missing.append(key)
+
+        # compute the other ones frame by frame, with the same engine as the dense grid
+        moment_weights = window_moment_weights(window_size) if missing else None
+        for frame in sorted(set(key[0] for key in missing)):
+            frame_windows = np.array([key[1:] for key in missing if key[0] == frame])
+            im_theta, im_ecc = frame_local_order(imstack[frame], None if im_mask is None else im_mask[frame], rpos, cpos, radius,
+                                                 moment_weights, intensity_thresh, eccentricity_thresh,
+                                                 fft_workers=fft_workers, windows=frame_windows.T)
+            theta_stack[frame][frame_windows[:, 0], frame_windows[:, 1]] = im_theta[frame_windows[:, 0], frame_windows[:, 1]]
+            ecc_stack[frame][frame_windows[:, 0], frame_windows[:, 1]] = im_ecc[frame_windows[:, 0], frame_windows[:, 1]]
+
+        # add the new windows to the cache and drop the least recently used ones
+        for key in missing:
+            cache[cache_key + key] = (theta_stack[key], ecc_stack[key])
+        while len(cache) > cache_size:
+            cache.popitem(last=False)
+
+    # length of the orientation vectors (NaN where there is no orientation)
+    u_stack = np.cos(theta_stack.reshape(N_images, -1)) * arrow_length
+    v_stack = np.sin(theta_stack.reshape(N_images, -1)) * arrow_length
+
+    # reduce dimensions if only one frame, the same outputs as image_local_order
+    if N_images == 1:
+        return x, y, u_stack[0], v_stack[0], theta_stack[0], ecc_stack[0]
+
+    return x, y, list(u_stack), list(v_stack), list(theta_stack), list(ecc_stack)
+
+def image_local_order_tiled(image, window_size = 33, overlap = 0.5, im_mask = None, intensity_thresh = 0, eccentricity_thresh = 0,
+                            tile_size = 2048, out = None, n_workers = 1, executor = None, fft_workers = None):
+    # open the image without reading it if a path is given (.npy files or uncompressed tiffs)
+    if isinstance(image, str):
+        image = np.load(image, mmap_mode='r') if image.endswith('.npy') else tifffile.memmap(image, mode='r')
+    if isinstance(im_mask, str):
+        im_mask = np.load(im_mask, mmap_mode='r') if im_mask.endswith('.npy') else tifffile.memmap(im_mask, mode='r')
+
+    # odd window size, radius and r,c positions of the windows (same grid as image_local_order)
+    window_size, radius, rpos, cpos = window_grid(image.shape, window_size, overlap)
+    step = int(window_size * overlap)
+
+    # moment weights of the band pass mask of the window
+    moment_weights = window_moment_weights(window_size)
+
+    # make the theta and eccentricity grids, memory-mapped if a folder is given
+    if out is None:
+        im_theta = np.full((len(rpos), len(cpos)), np.nan)
+        im_ecc = np.full((len(rpos), len(cpos)), np.nan)
+    elif isinstance(out, str):
+        os.makedirs(out, exist_ok=True)
+        im_theta = np.lib.format.open_memmap(os.path.join(out, 'theta.npy'), mode='w+', shape=(len(rpos), len(cpos)))
+        im_ecc = np.lib.format.open_memmap(os.path.join(out, 'eccentricity.npy'), mode='w+', shape=(len(rpos), len(cpos)))
+    else:
+        im_theta, im_ecc = out
+
+    # split the grid into tiles of about tile_size pixels
+    n_per_tile = max(1, tile_size // step)
+    tiles = [(i, j) for i in range(0, len(rpos), n_per_tile) for j in range(0, len(cpos), n_per_tile)]
+
+    tile_local_order = partial(frame_local_order, radius=radius, moment_weights=moment_weights,
+                               intensity_thresh=intensity_thresh, eccentricity_thresh=eccentricity_thresh,
+                               fft_workers=fft_workers)
+
+    pool = executor
+    if pool is None and n_workers > 1:
+        pool = ThreadPoolExecutor(max_workers=n_workers)
+    # only read as many tiles as there are workers (of the executor, if one is given) at a time
+    # so memory is bounded by the tile size
+    n_round = max(1, executor_workers(executor, n_workers))
+    try:
+        for start in range(0, len(tiles), n_round):
+            tile_images, tile_masks, tile_rpos, tile_cpos = [], [], [], []
+            for i, j in tiles[start:start + n_round]:
+                r_tile = rpos[i:i + n_per_tile]
+                c_tile = cpos[j:j + n_per_tile]
+                # read the tile with a halo of the window radius around its windows
+                top, bottom = r_tile[0] - radius, r_tile[-1] + radius + 1
+                left, right = c_tile[0] - radius, c_tile[-1] + radius + 1
+                tile_images.append(np.asarray(image[top:bottom, left:right]))
+                tile_masks.append(None if im_mask is None else np.asarray(im_mask[top:bottom, left:right]).astype('bool'))
+                tile_rpos.append(r_tile - top)
+                tile_cpos.append(c_tile - left)
+
+            if pool is not None:
+                tile_results = pool.map(tile_local_order, tile_images, tile_masks, tile_rpos, tile_cpos)
+            else:
+                tile_results = map(tile_local_order, tile_images, tile_masks, tile_rpos, tile_cpos)
+
+            # write the tiles into the output grids
+            for (i, j), (theta, ecc) in zip(tiles[start:start + n_round], tile_results):
+                im_theta[i:i + theta.shape[0], j:j + theta.shape[1]] = theta
+                im_ecc[i:i + ecc.shape[0], j:j + ecc.shape[1]] = ecc
+    finally:
+        if executor is None and pool is not None:
+            pool.shutdown()
+
+    if isinstance(im_theta, np.memmap):
+        im_theta.flush()
+        im_ecc.flush()
+
+    # the x, y positions are np.tile(cpos, len(rpos)) and np.repeat(rpos, len(cpos)), as in image_local_order
+    return rpos, cpos, im_theta, im_ecc
+
+def structure_tensor_calibration(image_list, window_size = 33, overlap = 0.5, im_mask = None, intensity_thresh = 0):
+    # compare the structure tensor engine against the FFT engine on the same images
+    records = []
+    for image in image_list:
+        # read in the image if a path is given
+        im = io.imread(image) if isinstance(image, str) else np.asarray(image)
+
+        # run both engines without eccentricity filtering
+        _,_,_,_,fft_theta,fft_ecc = image_local_order(im, window_size, overlap, im_mask, intensity_thresh, 0)
+        _,_,_,_,st_theta,st_coherence = image_local_order(im, window_size, overlap, im_mask, intensity_thresh, 0,
+                                                          engine='structure_tensor')
+        fft_theta, fft_ecc = np.ravel(fft_theta), np.ravel(fft_ecc)
+        st_theta, st_coherence = np.ravel(st_theta), np.ravel(st_coherence)
+
+        # only compare the windows measured by both engines
+        valid = ~np.isnan(fft_theta) & ~np.isnan(st_theta)
+        # angle difference between the orientations, wrapped to [0, pi/2]
+        angle_diff = np.abs(np.angle(np.exp(2j * (fft_theta[valid] - st_theta[valid])))) / 2
+
+        if np.count_nonzero(valid) > 1:
+            correlation = spearmanr(fft_ecc[valid], st_coherence[valid])[0]
+            slope, intercept = np.polyfit(st_coherence[valid], fft_ecc[valid], 1)
+        else:
+            correlation, slope, intercept = np.nan, np.nan, np.nan
+
+        records.append({
+            'image': image if isinstance(image, str) else len(records),
+            'n_windows': np.count_nonzero(valid),
+            # agreement of the angles
+            'median_angle_difference': np.rad2deg(np.median(angle_diff)) if len(angle_diff) else np.nan,
+            'fraction_within_10deg': np.mean(angle_diff < np.deg2rad(10)) if len(angle_diff) else np.nan,
+            # how the coherence maps onto the eccentricity (to translate eccentricity_thresh)
+            'coherence_eccentricity_spearman': correlation,
+            'eccentricity_vs_coherence_slope': slope,
+            'eccentricity_vs_coherence_intercept': intercept,
+        })
+
+    return pd.DataFrame(records)
+
+def summed_area_table(a):
+    # cumulative sum over rows and cols, with a row and col of zeros in front
+    return np.pad(np.cumsum(np.cumsum(a, axis=0), axis=1), ((1, 0), (1, 0)))
+
+def order_parameter_tables(im_theta):
+    # cos(a-b)^2 - 0.5 = 0.5 * (cos2a*cos2b + sin2a*sin2b), so the order parameter only needs
+    # NaN-aware box sums of cos2θ and sin2θ (and the number of valid angles)
+    valid = ~np.isnan(im_theta)
+    cos2 = np.where(valid, np.cos(2 * im_theta), 0)
+    sin2 = np.where(valid, np.sin(2 * im_theta), 0)
+
+    return cos2, sin2, valid, summed_area_table(cos2), summed_area_table(sin2), summed_area_table(valid)
+
+def order_parameter_field(tables, neighborhood_radius, include_center=False):
+    cos2, sin2, valid, cos2_table, sin2_table, valid_table = tables
+    # order parameter of every window with a full neighborhood, NaN everywhere else
+    N_rows, N_cols = valid.shape
+    field = np.full((N_rows, N_cols), np.nan)
+    size = 2 * neighborhood_radius + 1
+    if size > N_rows or size > N_cols:
+        return field
+
+    # sum of the (2r+1)x(2r+1) neighborhood of every window from the summed-area tables
+    def box_sum(table):
+        return table[size:, size:] - table[:-size, size:] - table[size:, :-size] + table[:-size, :-size]
+
+    center = (slice(neighborhood_radius, N_rows - neighborhood_radius), slice(neighborhood_radius, N_cols - neighborhood_radius))
+    cos2_sum = box_sum(cos2_table)
+    sin2_sum = box_sum(sin2_table)
+    count = box_sum(valid_table)
+    # leave out the window itself
+    if not include_center:
+        cos2_sum = cos2_sum - cos2[center]
+        sin2_sum = sin2_sum - sin2[center]
+        count = count - valid[center]
+
+    # 2 * mean(cos(a-b)^2 - 0.5) over the valid neighbors, only if the window and a neighbor are valid
+    defined = valid[center] & (count > 0)
+    field[center] = np.where(defined, (cos2[center] * cos2_sum + sin2[center] * sin2_sum) / np.maximum(count, 1), np.nan)
+
+    return field
+
+def calculate_order_parameter_radii(im_theta_stack, neighborhood_radii):
 
     # check if it's a list
     if type(im_theta_stack) == np.ndarray:
@@ -253,26 +863,17 @@ def calculate_order_parameter(im_theta_stack, neighborhood_radius):
     # get the number of images
     N_images = len(im_theta_stack)
 
-    # empty list to hold order parameter values for each image
+    # empty list to hold order parameter values (one per radius) for each image
     im_orderparameter_stack = []
 
     for im_theta in im_theta_stack:
-        order_list = []
-
-        rpos = np.arange(neighborhood_radius,im_theta.shape[0]-neighborhood_radius)
-        cpos = np.arange(neighborhood_radius,im_theta.shape[1]-neighborhood_radius)
-
-        for r in rpos:
-            for c in cpos:
-                search_window = im_theta[r-neighborhood_radius:r+neighborhood_radius+1,c-neighborhood_radius:c+neighborhood_radius+1]
-                vector_array = np.ones_like(search_window) * im_theta[r,c]
-                order_array = np.cos(search_window - vector_array) ** 2 - 0.5
-                order_array = np.delete(order_array, (2*neighborhood_radius + 1)**2 // 2)
-                if not np.isnan(order_array).all() == True:
-                    if order_array.size > 0:
-                        order_list.append(2 * np.nanmean(order_array))
-
-        im_orderparameter_stack.append(np.nanmedian(order_list))
+        # the summed-area tables are shared by all the radii
+        tables = order_parameter_tables(im_theta)
+        order_radii = []
+        for neighborhood_radius in neighborhood_radii:
+            field = order_parameter_field(tables, neighborhood_radius)
+            order_radii.append(np.nanmedian(field[~np.isnan(field)]))
+        im_orderparameter_stack.append(np.array(order_radii))
 
     # Reduce dimensions if only one image
     if N_images == 1:
@@ -280,51 +881,47 @@ def calculate_order_parameter(im_theta_stack, neighborhood_radius):
 
     return im_orderparameter_stack
 
-def parameter_search(image_list, min_win_size, win_size_interval, overlap, plot_figure=True):
-    # turn off warning for division by NaN
-    np.seterr(divide='ignore', invalid='ignore')
-    
-    # read in an image to get the image shape
-    im = io.imread(image_list[0])
-    
-    # set max win size - this is arbitary but would give you 3 windows with an overlap of 50%
-    max_win_size = (np.max(im.shape) -1 ) // 3 # -1 accounts for rare case where image is perfectly divisble by 3 into an even number
-    
-    # make a list of window sizes to search through
-    win_size_list = np.arange(min_win_size, max_win_size, win_size_interval)
-    
-    # make them odd if they aren't already
-    win_size_list[win_size_list % 2 == 0] += 1
+def calculate_order_parameter(im_theta_stack, neighborhood_radius):
+
+    # calculate the order parameter of each image for this one radius
+    im_orderparameter_stack = calculate_order_parameter_radii(im_theta_stack, [neighborhood_radius])
+
+    # one value per image, a single value if only one image
+    if type(im_orderparameter_stack) == list:
+        return [order_radii[0] for order_radii in im_orderparameter_stack]
+
+    return im_orderparameter_stack[0]
+
+def window_size_order_parameter(im, win_size, overlap, cache_dir=None):
+    # calculate the theta matric (or read it from an earlier run)
+    _,_,_,_,im_theta,_ = image_local_order(im, window_size = win_size, overlap = overlap, plot_overlay = False, plot_angles=False, plot_eccentricity=False,
+                                          cache_dir=cache_dir)
 
+    # get the number of windows
+    n_windows = np.max(im_theta.shape)
+
+    # make a list of neighborhood radii to measure
+    neighborhood_list = np.arange(1, ((n_windows - 1) // 2) + 1)
+
+    # calculate the order parameter for all the radii from one set of summed-area tables
+    return neighborhood_list, calculate_order_parameter_radii(im_theta, neighborhood_list)
+
+def window_size_sweep(images, win_size_list, overlap, pool=None, cache_dir=None):
     # make empty lists to hold the data
     win_size_result, image_result, order_parameter_result, neighborhood_result = [], [], [], []
-    
+
     # for loops to go through each image, window size and neighborhood radius
-    for image in image_list:
-        # Read in the image
-        im = io.imread(image).astype('float32')
-        
-        # loop through the different window sizes
-        for win_size in win_size_list:
-            # calculate the theta matric       
-            _,_,_,_,im_theta,_ = image_local_order(im, window_size = win_size, overlap = overlap, plot_overlay = False, plot_angles=False, plot_eccentricity=False)
-            
-            # get the number of windows
-            n_windows = np.max(im_theta.shape)
-            
-            # make a list of neighborhood radii to measure
-            neighborhood_list = np.arange(1, ((n_windows - 1) // 2) + 1)
-            
-            # loop through all neighborhood radiui
-            for neighborhood in neighborhood_list:
-                # calculate the order parameter
-                im_orderparameter = calculate_order_parameter(im_theta, neighborhood_radius=neighborhood)
-                
-                # add the parameters to the relevant lists
-                win_size_result.append(win_size)
-                image_result.append(image)
-                order_parameter_result.append(im_orderparameter)
-                neighborhood_result.append(neighborhood)
+    for image, im in images:
+        search_window_size = partial(window_size_order_parameter, im, overlap=overlap, cache_dir=cache_dir)
+        window_results = pool.map(search_window_size, win_size_list) if pool is not None else map(search_window_size, win_size_list)
+
+        # loop through the different window sizes (in order)
+        for win_size, (neighborhood_list, im_orderparameter_radii) in zip(win_size_list, window_results):
+            # add the parameters to the relevant lists
+            win_size_result.extend([win_size] * len(neighborhood_list))
+            image_result.extend([image] * len(neighborhood_list))
+            order_parameter_result.extend(im_orderparameter_radii)
+            neighborhood_result.extend(neighborhood_list)
 
     # make a dictionary of our lists
     data_dict = {
@@ -333,25 +930,120 @@ def parameter_search(image_list, min_win_size, win_size_interval, overlap, plot_
         'order_parameter' : order_parameter_result,
         'image' : image_result
     }
-    
+
     # convert the dictionary to a dataframe
-    Order_dataframe = pd.DataFrame(data_dict)  
-    
-    # Find the number of different windows and neighborhoods tested 
-    N_windows = len(win_size_list)
-    neighborhood_list = np.arange(1,np.max(Order_dataframe['neighborhood_radius'])+1)
-    N_neighborhood = len(neighborhood_list)
+    return pd.DataFrame(data_dict)
 
+def window_neighborhood_matrix(Order_dataframe, win_size_list):
     # make a matrix of window size (rows) and neighborhood size (cols)
-    window_neighborhood = np.empty((N_windows, N_neighborhood))
-    window_neighborhood[:] = np.nan
-
-    # populate the matrix with the median of the order parameter of all the images
-    for i,win_size in enumerate(win_size_list):
-        for j, neighborhood in enumerate(neighborhood_list):
-            temp = Order_dataframe[(Order_dataframe.window_size==win_size) & (Order_dataframe.neighborhood_radius==neighborhood)]
-            if len(temp) > 0:
-                window_neighborhood[i,j] = np.median(temp.order_parameter)
+    neighborhood_list = np.arange(1,np.max(Order_dataframe['neighborhood_radius'])+1)
+
+    # the median of the order parameter of all the images for each cell, NaN if one of the images is NaN (as np.median)
+    cells = [Order_dataframe['window_size'], Order_dataframe['neighborhood_radius']]
+    window_neighborhood = Order_dataframe['order_parameter'].groupby(cells).median()
+    window_neighborhood = window_neighborhood.mask(Order_dataframe['order_parameter'].isna().groupby(cells).any())
+
+    return window_neighborhood.unstack().reindex(index=win_size_list, columns=neighborhood_list).to_numpy(dtype='float64')
+
+def window_size_scores(Order_dataframe, reference_dataframe=None):
+    # window sizes evaluated so far and their median order parameter curves
+    win_size_list = np.unique(Order_dataframe['window_size'])
+    window_neighborhood = window_neighborhood_matrix(Order_dataframe, win_size_list)
+
+    # how fast the median order parameter changes between neighbouring window sizes
+    with np.errstate(all='ignore'):
+        change = np.nanmean(np.abs(np.diff(window_neighborhood, axis=0)), axis=1)
+    change = np.nan_to_num(change, nan=0)
+    if reference_dataframe is None:
+        return win_size_list, change
+
+    # smallest p-value against the reference at each window size, over the cells measured in both samples
+    cells = order_parameter_cells(Order_dataframe)
+    reference_cells = order_parameter_cells(reference_dataframe)
+    shared = [cell for cell in cells if cell in reference_cells]
+    p_values = rank_sum_pvalues([cells[cell] for cell in shared], [reference_cells[cell] for cell in shared])
+    p_min = np.full(len(win_size_list), np.nan)
+    np.fmin.at(p_min, np.searchsorted(win_size_list, [win_size for win_size, neighborhood in shared]), p_values)
+    p_min = np.nan_to_num(p_min, nan=1)
+
+    # rank the intervals on both criteria (fast change and small p-value at either end)
+    change_rank = np.argsort(np.argsort(-change))
+    p_rank = np.argsort(np.argsort(np.minimum(p_min[:-1], p_min[1:])))
+    return win_size_list, -(change_rank + p_rank).astype('float64')
+
+def adaptive_window_sizes(Order_dataframe, win_size_list, n_refine, reference_dataframe=None):
+    # score the intervals between the window sizes evaluated so far
+    evaluated, scores = window_size_scores(Order_dataframe, reference_dataframe)
+
+    # pick the best intervals that still have untested window sizes in them
+    new_sizes = []
+    for i in np.argsort(-scores, kind='stable'):
+        candidates = win_size_list[(win_size_list > evaluated[i]) & (win_size_list < evaluated[i + 1])]
+        if len(candidates) > 0:
+            # split the interval in the middle (on a log scale)
+            new_sizes.append(candidates[np.argmin(np.abs(np.log(candidates) - 0.5 * np.log(evaluated[i] * evaluated[i + 1])))])
+        if len(new_sizes) == n_refine:
+            break
+
+    return np.array(new_sizes, dtype=win_size_list.dtype)
+
+def parameter_search(image_list, min_win_size, win_size_interval, overlap, plot_figure=True, n_workers=1, cache_dir=None,
+                     search='grid', n_coarse=6, n_refine=2, max_rounds=3, reference_dataframe=None):
+    # turn off warning for division by NaN
+    np.seterr(divide='ignore', invalid='ignore')
+
+    # make the cache folder for the theta fields
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # read in an image to get the image shape
+    im = io.imread(image_list[0]).astype('float32')
+    
+    # set max win size - this is arbitary but would give you 3 windows with an overlap of 50%
+    max_win_size = (np.max(im.shape) -1 ) // 3 # -1 accounts for rare case where image is perfectly divisble by 3 into an even number
+    
+    # make a list of window sizes to search through
+    win_size_list = np.arange(min_win_size, max_win_size, win_size_interval)
+    
+    # make them odd if they aren't already
+    win_size_list[win_size_list % 2 == 0] += 1
+
+    # run the window sizes in parallel on a process pool
+    pool = ProcessPoolExecutor(max_workers=n_workers) if n_workers > 1 else None
+    try:
+        if search == 'grid':
+            # read the rest of the images one at a time (each one only once)
+            images = chain([(image_list[0], im)], ((image, io.imread(image).astype('float32')) for image in image_list[1:]))
+            Order_dataframe = window_size_sweep(images, win_size_list, overlap, pool, cache_dir)
+        elif search == 'adaptive':
+            # the images are kept in memory between the rounds
+            images = [(image_list[0], im)] + [(image, io.imread(image).astype('float32')) for image in image_list[1:]]
+
+            # start with window sizes spread on a log scale
+            coarse = np.geomspace(win_size_list[0], win_size_list[-1], min(n_coarse, len(win_size_list)))
+            coarse = np.unique(win_size_list[np.argmin(np.abs(win_size_list[:, np.newaxis] - coarse), axis=0)])
+            Order_dataframe = window_size_sweep(images, coarse, overlap, pool, cache_dir)
+
+            # then add window sizes where the order parameter changes fastest (or the p-values are smallest)
+            for refine_round in range(max_rounds):
+                new_sizes = adaptive_window_sizes(Order_dataframe, win_size_list, n_refine, reference_dataframe)
+                if len(new_sizes) == 0:
+                    break
+                Order_dataframe = pd.concat([Order_dataframe, window_size_sweep(images, new_sizes, overlap, pool, cache_dir)])
+
+            # same row order as the grid search (image, window size, neighborhood)
+            image_order = Order_dataframe['image'].map({image: i for i, image in enumerate(image_list)})
+            Order_dataframe = Order_dataframe.iloc[np.lexsort((Order_dataframe['window_size'], image_order))].reset_index(drop=True)
+            # one row of window_neighborhood per evaluated window size, parameter_comparison lines up two searches by window size
+            win_size_list = np.unique(Order_dataframe['window_size'])
+        else:
+            raise ValueError(f"Unknown search '{search}', use 'grid' or 'adaptive'")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    # make a matrix of window size (rows) and neighborhood size (cols) with the median of the order parameter of all the images
+    window_neighborhood = window_neighborhood_matrix(Order_dataframe, win_size_list)
     
     if plot_figure:
         # get labels for the plots
@@ -371,28 +1063,112 @@ def parameter_search(image_list, min_win_size, win_size_interval, overlap, plot_
 
     return Order_dataframe, window_neighborhood
 
-def parameter_comparison(Order_dataframe1, window_neighborhood1, Order_dataframe2, window_neighborhood2, save_figures=False, save_path = ''):
-    # Find the number of different windows and neighborhoods tested 
-    win_size_list = sorted(np.unique(Order_dataframe1['window_size']))
+def order_parameter_cells(Order_dataframe):
+    # pre-sorted order parameter values of every (window size, neighborhood radius) cell, from a single groupby
+    return {cell: np.sort(values.to_numpy(dtype='float64'))
+            for cell, values in Order_dataframe.groupby(['window_size', 'neighborhood_radius'])['order_parameter']}
+
+def rank_sum_pvalues(cells1, cells2):
+    # Mann-Whitney p-value of every pair of cells, with one call per batch of cells of the same shape
+    p_values = np.full(len(cells1), np.nan)
+    batches = {}
+    for i, (x, y) in enumerate(zip(cells1, cells2)):
+        pooled = np.sort(np.concatenate([x, y]))
+        # a NaN gives a NaN p-value
+        if np.isnan(pooled).any():
+            continue
+        # same choice of method as mannwhitneyu would make for this cell on its own
+        # (with 'auto' a batch would switch every cell to asymptotic if any of them has ties)
+        ties = np.any(pooled[1:] == pooled[:-1])
+        method = 'asymptotic' if (len(x) > 8 and len(y) > 8) or ties else 'exact'
+        batches.setdefault((len(x), len(y), method), []).append(i)
+
+    for (n1, n2, method), idx in batches.items():
+        x = np.stack([cells1[i] for i in idx])
+        y = np.stack([cells2[i] for i in idx])
+        p_values[idx] = mannwhitneyu(x, y, method=method, axis=1)[1]
+
+    return p_values
+
+def permutation_exceedances(ranks, n1, n_resamples, seed):
+    # permute the pooled ranks of a batch of cells and count the U statistics at least as extreme as the observed ones
+    rng = np.random.default_rng(seed)
+    n = ranks.shape[1]
+    center = n1 * (n - n1) / 2
+    observed = np.abs(ranks[:, :n1].sum(axis=1) - n1 * (n1 + 1) / 2 - center)
+    permutations = np.argsort(rng.random((n_resamples, n)), axis=1)[:, :n1]
+    permuted = np.abs(ranks[:, permutations].sum(axis=2) - n1 * (n1 + 1) / 2 - center)
+
+    return np.sum(permuted >= observed[:, np.newaxis] - 1e-9, axis=1)
+
+def permutation_pvalues(cells1, cells2, n_resamples, n_workers=1, seed=0, chunk_size=1000):
+    # two-sided permutation test of the Mann-Whitney U statistic for every pair of cells
+    p_values = np.full(len(cells1), np.nan)
+    batches = {}
+    for i, (x, y) in enumerate(zip(cells1, cells2)):
+        if not (np.isnan(x).any() or np.isnan(y).any()):
+            batches.setdefault((len(x), len(y)), []).append(i)
+
+    # the resamples are split in fixed chunks with their own seeds, so the result doesn't depend on n_workers
+    chunks = [min(chunk_size, n_resamples - start) for start in range(0, n_resamples, chunk_size)]
+    pool = ProcessPoolExecutor(max_workers=n_workers) if n_workers > 1 else None
+    try:
+        for (n1, n2), idx in batches.items():
+            ranks = rankdata(np.concatenate([np.stack([cells1[i] for i in idx]), np.stack([cells2[i] for i in idx])], axis=1), axis=1)
+            seeds = np.random.SeedSequence([seed, n1, n2]).spawn(len(chunks))
+            count_args = (repeat(ranks), repeat(n1), chunks, seeds)
+            counts = pool.map(permutation_exceedances, *count_args) if pool is not None else map(permutation_exceedances, *count_args)
+            p_values[idx] = (1 + np.sum(list(counts), axis=0)) / (1 + n_resamples)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return p_values
+
+def window_neighborhood_frame(Order_dataframe, window_neighborhood):
+    # a window_neighborhood matrix of parameter_search labelled with its window sizes (rows) and neighborhood radii (cols),
+    # the window sizes are the ones in Order_dataframe (an adaptive search only evaluates some of them)
+    win_size_list = np.unique(Order_dataframe['window_size'])
+    neighborhood_list = np.arange(1,np.max(Order_dataframe['neighborhood_radius'])+1)
+    if np.shape(window_neighborhood) != (len(win_size_list), len(neighborhood_list)):
+        raise ValueError(f"window_neighborhood has shape {np.shape(window_neighborhood)}, but its Order_dataframe has "
+                         f"{len(win_size_list)} window sizes and {len(neighborhood_list)} neighborhood radii")
+
+    return pd.DataFrame(window_neighborhood, index=win_size_list, columns=neighborhood_list)
+
+def parameter_comparison(Order_dataframe1, window_neighborhood1, Order_dataframe2, window_neighborhood2, save_figures=False, save_path = '',
+                         n_permutations=0, n_workers=1, seed=0):
+    # Find the number of different windows and neighborhoods tested in either sample
+    win_size_list = sorted(set(np.unique(Order_dataframe1['window_size'])) | set(np.unique(Order_dataframe2['window_size'])))
     N_windows = len(win_size_list)
-    neighborhood_list = sorted(np.unique(Order_dataframe1['neighborhood_radius']))
+    neighborhood_list = sorted(set(np.unique(Order_dataframe1['neighborhood_radius'])) | set(np.unique(Order_dataframe2['neighborhood_radius'])))
     N_neighborhood = len(neighborhood_list)
 
+    # line up the rows and cols of both matrices by window size and neighborhood radius
+    # (NaN where a sample didn't evaluate that window size, e.g. after an adaptive search)
+    window_neighborhood1 = window_neighborhood_frame(Order_dataframe1, window_neighborhood1).reindex(
+        index=win_size_list, columns=neighborhood_list).to_numpy(dtype='float64')
+    window_neighborhood2 = window_neighborhood_frame(Order_dataframe2, window_neighborhood2).reindex(
+        index=win_size_list, columns=neighborhood_list).to_numpy(dtype='float64')
+
     # make a matrix of window size (rows) and neighborhood size (cols)
     p_median = np.empty((N_windows, N_neighborhood))
     p_median[:] = np.nan
 
-    # populate the matrix with the median of the order parameter of all the images
-    for i,win_size in enumerate(win_size_list):
-        for j, neighborhood in enumerate(neighborhood_list):
-            # select the values we need
-            temp1 = Order_dataframe1[(Order_dataframe1.window_size==win_size) & (Order_dataframe1.neighborhood_radius==neighborhood)]
-            temp2 = Order_dataframe2[(Order_dataframe2.window_size==win_size) & (Order_dataframe2.neighborhood_radius==neighborhood)]
-            # make sure the list isn't full of nan
-            if (len(temp1) > 0) and (len(temp2) > 0):
-                # calculate the p-value between the two groups
-                _, p_median[i,j] = mannwhitneyu(temp1.order_parameter, temp2.order_parameter)
+    # group both dataframes into the values of each cell once
+    cells1 = order_parameter_cells(Order_dataframe1)
+    cells2 = order_parameter_cells(Order_dataframe2)
+    # only the cells measured in both samples
+    cells = [cell for cell in cells1 if cell in cells2]
+    cell_rows = [win_size_list.index(win_size) for win_size, neighborhood in cells]
+    cell_cols = [neighborhood_list.index(neighborhood) for win_size, neighborhood in cells]
 
+    # calculate the p-values between the two groups for all the cells
+    if n_permutations > 0:
+        p_median[cell_rows, cell_cols] = permutation_pvalues([cells1[cell] for cell in cells], [cells2[cell] for cell in cells],
+                                                             n_permutations, n_workers, seed)
+    else:
+        p_median[cell_rows, cell_cols] = rank_sum_pvalues([cells1[cell] for cell in cells], [cells2[cell] for cell in cells])
 
     # difference between order parameters
     order_diff = window_neighborhood1-window_neighborhood2
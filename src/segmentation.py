@@ -3,15 +3,19 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import os 
+import time
+import cv2
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import AFT_tools as AFT
 
+from scipy import ndimage, sparse
+from scipy.sparse import csgraph
 from skimage import img_as_float, io
-from skimage.feature import hessian_matrix, hessian_matrix_eigvals
+from skimage.feature import hessian_matrix
 from skimage.morphology import skeletonize
 from skimage.measure import label
 
 from skan import Skeleton, summarize
-from skan.csr import skeleton_to_nx
 
 from fractal import box_counting
 
@@ -138,46 +142,43 @@ def remove_short_components(skel, min_len):
 
 #hessian fillter
 
-def hessian_ridge_response(image, sigma, darkline):
+def hessian_ridge_response(image, sigma, darkline, out=None):
     img = img_as_float(image) 
 
     H_elems = hessian_matrix(img, sigma=sigma, order='xy') #give a hessian matrix with gausian filter (sigma defined in function below) 
-    #good explanation here: 
-    l1, l2 = hessian_matrix_eigvals(H_elems) #give a 2 eigenvalues
-
-    abs1 = np.abs(l1)
-    abs2 = np.abs(l2)
-    swap = abs2 > abs1 #take the highest eugenvalue
-
-    l1_swapped = l1.copy()
-    l2_swapped = l2.copy()
-
-    '''
-    H, W = l1.shape
-
-    for y in range(H):
-        for x in range(W):
-            if abs(l2[y, x]) > abs(l1[y, x]):
-                l1_swapped[y, x] = l2[y, x]
-                l2_swapped[y, x] = l1[y, x]
-    '''
-    #we make all eugenvalues l1 to be the highest to easier interpretation. Thus, l1 will represent the maximum curvature
-    #ChatGPT rewrite faster way
-    l1_swapped[swap], l2_swapped[swap] = l2[swap], l1[swap]
-
-    #save only ridge-points 
-    if darkline:
-        response = np.maximum(0, -l1_swapped) #if we have darklines our valleys will have a positive value
-    else:
-        response = np.maximum(0, l1_swapped) #if we have bright lines, our valleys will have a negative value 
-
-    resp = response - response.min() #make the lowest value 0
-    maxv = resp.max() #
+    return ridge_response_from_hessian(H_elems, darkline, out=out)
+
+#ridge response (0-255) from the hessian elements (Hxx, Hxy, Hyy): the eigenvalue with the highest magnitude, clipped at 0.
+#The 2 eigenvalues are m +- d (m = (Hxx + Hyy) / 2, d = sqrt(((Hxx - Hyy) / 2)**2 + Hxy**2) >= 0), the one with the highest
+#magnitude is m + d where m >= 0 and m - d where m < 0. So the response of bright lines is m + d where m >= 0 and 0
+#elsewhere, the one of dark lines is d - m where m < 0 and 0 elsewhere, without computing and swapping both eigenvalues.
+#Computed in float32 in place, in `out` (float32 array of the image shape) if given.
+def ridge_response_from_hessian(H_elems, darkline, out=None):
+    Hxx, Hxy, Hyy = H_elems
+
+    #d
+    d = np.subtract(Hxx, Hyy, dtype=np.float32)
+    d *= 0.5
+    d *= d
+    d += np.multiply(Hxy, Hxy, dtype=np.float32)
+    np.sqrt(d, out=d)
+
+    #m, with the sign of the lines
+    response = np.add(Hxx, Hyy, out=out, dtype=np.float32)
+    response *= -0.5 if darkline else 0.5
+    background = response <= 0 if darkline else response < 0
+
+    #save only ridge-points
+    response += d
+    response[background] = 0
+
+    #min-max normalization to the 255 range; it needs to tresholding in ridge_mask_for_linewidth
+    response -= response.min()
+    maxv = response.max()
     if maxv > 0:
-        resp = resp / maxv #make min-max normalization to [0,1]
-    resp = (resp * 255).astype(np.float32) #transform back to 255 range; it needs to tresholding in ridge_mask_for_linewidth
+        response *= 255 / maxv
 
-    return resp
+    return response
 
 #function to process results of Ridge Detection by lineWidth
 
@@ -187,7 +188,8 @@ def ridge_mask_for_linewidth(
     im_mask,
     contrastLow,
     contrastHigh,
-    darkline
+    darkline,
+    out=None
 ):
     sigma = calcSigma(lineWidth)
 
@@ -198,7 +200,7 @@ def ridge_mask_for_linewidth(
         lineWidth, sigma, contrastLow, contrastHigh, darkline
     )
 
-    response = hessian_ridge_response(image, sigma, darkline=darkline)
+    response = hessian_ridge_response(image, sigma, darkline=darkline, out=out)
     #exclude responce values that are in the image mask with background pixels on -np.inf 
     if im_mask is not None:
         response[im_mask] = -np.inf
@@ -206,6 +208,77 @@ def ridge_mask_for_linewidth(
     mask = (response >= lower) & (response <= upper)
     return mask, response, lower, upper
 
+#mask of one line width packed in bits (np.packbits of the flattened mask), with the seconds it took
+def packed_ridge_mask_for_linewidth(image, lineWidth, im_mask, contrastLow, contrastHigh, darkline):
+    start = time.perf_counter()
+    mask = ridge_mask_for_linewidth(image, lineWidth, im_mask, contrastLow, contrastHigh, darkline)[0]
+    return lineWidth, np.packbits(mask, axis=None), time.perf_counter() - start
+
+#hessian (Hxx, Hxy, Hyy) of an already smoothed image, the same finite differences as hessian_matrix(order='xy')
+def hessian_of_smoothed(smoothed):
+    gradients = np.gradient(smoothed)
+    return [np.gradient(gradients[1], axis=1), np.gradient(gradients[1], axis=0), np.gradient(gradients[0], axis=0)]
+
+#linear interpolation of an array sampled every `factor` pixels back to the full shape
+#(pixel i of the image is at i / factor in the array, the edges are clamped)
+def upsample_linear(coarse, factor, shape):
+    M = np.array([[1 / factor, 0, 0], [0, 1 / factor, 0]])
+    return cv2.warpAffine(coarse, M, (shape[1], shape[0]), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                          borderMode=cv2.BORDER_REPLICATE)
+
+#hessians of the image for increasing sigmas from one gaussian scale space: every scale is smoothed from the previous one
+#(gaussians add up in sigma^2) instead of from the image. The image is zero padded once, so the borders are the same as
+#hessian_matrix(mode='constant') at every scale. With downsample the scale space is decimated by 2 whenever the smoothing
+#reaches downsample_sigma px of the current level, the coarse hessians are interpolated back to the full image.
+def hessian_scale_space(image, sigmas, downsample=False, downsample_sigma=4):
+    img = img_as_float(image)
+
+    #number of decimations, the padding has to stay a whole number of pixels at every level
+    n_levels = 0
+    if downsample:
+        while sigmas[-1] / 2**n_levels >= downsample_sigma:
+            n_levels += 1
+    step = 2**n_levels
+    pad = int(math.ceil((4 * sigmas[-1] + 1) / step)) * step
+    level = np.pad(img, pad)
+
+    factor = 1
+    level_sigma = 0
+    for sigma in sigmas:
+        if downsample and sigma / factor >= downsample_sigma and level_sigma >= 2:
+            #the image is smooth enough to be decimated without aliasing
+            level = level[::2, ::2]
+            factor *= 2
+            level_sigma /= 2
+        #smooth from the previous scale
+        target = math.sqrt(sigma**2 - 2 / 3 * (factor**2 - 1)) / factor
+        sigma_step = math.sqrt(target**2 - level_sigma**2)
+        level = ndimage.gaussian_filter(level, sigma_step, mode='constant', truncate=4.0)
+        level_sigma = target
+
+        crop = pad // factor
+        smoothed = level[crop:crop + -(-img.shape[0] // factor), crop:crop + -(-img.shape[1] // factor)]
+        H_elems = hessian_of_smoothed(smoothed)
+        if factor > 1:
+            #interpolate the hessian and not the ridge response, the response is clipped at 0
+            H_elems = [upsample_linear(H, factor, img.shape) / factor**2 for H in H_elems]
+        yield H_elems
+
+#masks of all line widths from one gaussian scale space, with the same thresholds as ridge_mask_for_linewidth
+def ridge_masks_scale_space(image, lineWidths, im_mask, contrastLow, contrastHigh, darkline, downsample=False):
+    sigmas = [calcSigma(lineWidth) for lineWidth in lineWidths]
+    #one response buffer for all line widths
+    response = np.empty(image.shape, np.float32)
+    for lineWidth, sigma, H_elems in zip(lineWidths, sigmas, hessian_scale_space(image, sigmas, downsample=downsample)):
+        lower = calcLowerThresh(lineWidth, sigma, contrastLow, contrastHigh, darkline)
+        upper = calcUpperThresh(lineWidth, sigma, contrastLow, contrastHigh, darkline)
+
+        ridge_response_from_hessian(H_elems, darkline, out=response)
+        if im_mask is not None:
+            response[im_mask] = -np.inf
+
+        yield lineWidth, (response >= lower) & (response <= upper)
+
 #old version, now works with skan
 
 '''
@@ -358,6 +431,234 @@ def compute_curvature_from_skeleton(
 
     return pd.DataFrame(results)
 
+#curvature of a patch: the mean curvature of its branches (at least min_pixels long) for every curvature window up to
+#the window size, averaged over the curvature windows with branches
+def patch_curvature(patch, windows_curvature, window_size, min_pixels):
+    curv_values = []
+
+    for w in windows_curvature:
+      if w <= window_size:
+          df_curv = compute_curvature_from_skeleton(
+              patch,
+              windows=[w],
+              min_pixels=min_pixels
+          )
+          col = f"curvature_w{w}"
+          if col in df_curv.columns:
+              curv_values.append(df_curv[col].mean())
+    return np.mean(curv_values) if curv_values else np.nan
+
+#degree of every skeleton pixel in the skan graph (0 off the skeleton), without building the graph: 1 is an endpoint,
+#2 a pixel inside a branch and 3 or more a junction, it is also the degree of the junctions and endpoints in
+#skeleton_to_nx. The 8-connected neighbours are counted with one 3x3 convolution. Like skan, the links between
+#junction pixels are then reduced to their minimum spanning tree (scipy, with the pixels in the same raster order as
+#skan so the ties are broken the same way), which only needs the few junction pixels.
+def skeleton_degrees(skel):
+    return skeleton_links(skel)[0]
+
+#degree of every skeleton pixel (see skeleton_degrees) and the total length of the links between the pixels that are
+#left, the sum of the branch distances of skan
+def skeleton_links(skel):
+    skel = skel.astype(bool)
+    side_kernel = np.array([[0, 1, 0], [1, 0, 1], [0, 1, 0]], np.uint8)
+    corner_kernel = np.array([[1, 0, 1], [0, 0, 0], [1, 0, 1]], np.uint8)
+    side = ndimage.convolve(skel.astype(np.uint8), side_kernel, mode='constant', cval=0) * skel
+    corner = ndimage.convolve(skel.astype(np.uint8), corner_kernel, mode='constant', cval=0) * skel
+    degree = side + corner
+    #every link is counted from both of its pixels
+    length = (np.sum(side) + math.sqrt(2) * np.sum(corner)) / 2
+
+    junction = degree >= 3
+    coords = np.argwhere(junction)
+    if len(coords) > 1:
+        #links between neighbouring junction pixels, with their length
+        index = np.full((skel.shape[0] + 2, skel.shape[1] + 2), -1)
+        index[1:-1, 1:-1][junction] = np.arange(len(coords))
+        rows, cols, lengths = [], [], []
+        for dr in (-1, 0, 1):
+            for dc in (-1, 0, 1):
+                if dr == 0 and dc == 0:
+                    continue
+                neighbour = index[coords[:, 0] + 1 + dr, coords[:, 1] + 1 + dc]
+                linked = neighbour >= 0
+                rows.append(np.flatnonzero(linked))
+                cols.append(neighbour[linked])
+                lengths.append(np.full(np.count_nonzero(linked), math.sqrt(2) if dr and dc else 1.0))
+        links = sparse.csr_matrix((np.concatenate(lengths), (np.concatenate(rows), np.concatenate(cols))),
+                                  shape=(len(coords), len(coords)))
+        #remove the links that aren't in the minimum spanning tree
+        tree = csgraph.minimum_spanning_tree(links)
+        removed = np.asarray(((links - (tree + tree.T)) != 0).sum(axis=1)).ravel()
+        degree[coords[:, 0], coords[:, 1]] -= removed.astype(degree.dtype)
+        length -= links.sum() / 2 - tree.sum()
+
+    return degree, length
+
+#skeleton features of all the windows (borders x1, x2, y1, y2) from one skeleton graph of the whole image. Every
+#feature is put on the pixels once (bincount of the flat pixel index) and summed in all the windows with a summed-area
+#table. Without clip the branches aren't cut at the window borders, so near the borders the endpoints, branch points
+#and branch length differ from the ones of the patches:
+#endpoints: the ends of the branches with a free end (2 for a separate branch, like the endpoints of the patches)
+#branch points: skeleton pixels with 3 branches (skeleton_degrees)
+#branch length: every step of a branch counts half on each of its 2 pixels
+#With clip the steps between 2 pixels on opposite sides of a window border are cut, the features are the ones of the
+#patches (except that the patches drop duplicate branches of the same length between 2 junctions):
+#endpoints and branch points: from the degree of every pixel without its steps that leave the window (a pixel left
+#with 1 step is an end, one left without any isn't a branch, as in skan), the pixels on the border rows and cols of the
+#windows are summed separately for every side they can leave the window on
+#branch length: only the steps with both pixels in the window, a step is put on its top left pixel and summed in the
+#window without its last row (col) if it goes down (right)
+#a window with a junction on its border is counted from its own patch instead (skeleton_links), as skan reduces the
+#links of the cut junction again
+#curvature: without clip the curvature of every branch (at least min_pixels long) is put on its middle pixel, the
+#curvature of a window is the mean of the branches in it for every curvature window, averaged over the curvature
+#windows (the branches aren't cut). With clip every branch is cut into its runs of consecutive pixels in the window,
+#the runs at least min_pixels long are the branches of the patch (patch_curvature for the windows counted from their
+#patch)
+def image_skeleton_window_features(skel, x1, x2, y1, y2, windows_curvature, window_size, min_pixels, clip=False):
+    sk = Skeleton(skel.astype(bool), spacing=1)
+    summary = summarize(sk, separator='_')
+    n_pixels = skel.size
+    #flat pixel index of every skeleton node
+    node_pixel = np.ravel_multi_index(tuple(sk.coordinates.astype(int).T), skel.shape)
+
+    def box_sums(raster, top=y1, bottom=y2, left=x1, right=x2):
+        #sum of the pixels in every box (the windows by default)
+        table = AFT.summed_area_table(raster)
+        bottom, right = np.maximum(bottom, top), np.maximum(right, left)
+        return table[bottom, right] - table[top, right] - table[bottom, left] + table[top, left]
+
+    def pixel_raster(pixels, values=None):
+        #values summed on their flat pixel index
+        return np.bincount(pixels, weights=values, minlength=n_pixels).reshape(skel.shape)
+
+    def window_sums(node_values, nodes):
+        #sum of the values of the nodes in every window
+        return box_sums(pixel_raster(node_pixel[nodes], node_values))
+
+    #steps between the consecutive pixels of every branch
+    paths = sk.paths.tocsr()
+    step = np.ones(len(paths.indices), bool)
+    step[paths.indptr[1:] - 1] = False  #the last pixel of a branch has no next step
+    step = np.flatnonzero(step)
+    step_src, step_dst = paths.indices[step], paths.indices[step + 1]
+    step_length = np.hypot(*(sk.coordinates[step_dst] - sk.coordinates[step_src]).T)
+
+    if clip:
+        coords = sk.coordinates.astype(int)
+        skeleton = skel.astype(bool)
+
+        #both ends of every step, with the row and col direction (-1, 0, 1) of the other pixel
+        end_node = np.concatenate([step_src, step_dst])
+        end_dir = np.concatenate([coords[step_dst] - coords[step_src], coords[step_src] - coords[step_dst]])
+
+        #the border rows (cols) of the windows and the side a step leaves the window on from them
+        row_parts = [(y1, y1 + 1, -1), (y1 + 1, y2 - 1, 0), (y2 - 1, y2, 1)]
+        col_parts = [(x1, x1 + 1, -1), (x1 + 1, x2 - 1, 0), (x2 - 1, x2, 1)]
+        endpoints, branch_points = 0, 0
+        for top, bottom, row_side in row_parts:
+            for left, right, col_side in col_parts:
+                #degree of the pixels without the steps that leave the window
+                leaves = ((row_side != 0) & (end_dir[:, 0] == row_side)) | ((col_side != 0) & (end_dir[:, 1] == col_side))
+                degree = pixel_raster(node_pixel[end_node[~leaves]])
+                endpoints = endpoints + box_sums(skeleton & (degree == 1), top, bottom, left, right)
+                branch_points = branch_points + box_sums(skeleton & (degree == 3), top, bottom, left, right)
+
+        #branch length of the steps with both pixels in the window
+        corner = np.minimum(coords[step_src], coords[step_dst])
+        extent = np.abs(coords[step_dst] - coords[step_src])
+        branch_length = 0
+        for down in (0, 1):
+            for across in (0, 1):
+                steps = (extent[:, 0] == down) & (extent[:, 1] == across)
+                lengths = pixel_raster(np.ravel_multi_index(tuple(corner[steps].T), skel.shape), step_length[steps])
+                branch_length = branch_length + box_sums(lengths, y1, y2 - down, x1, x2 - across)
+
+        #windows with a junction pixel (3 or more neighbours) on their border rows or cols are counted from the links of
+        #their own patch, skan reduces the links of a cut junction to their minimum spanning tree again
+        kernel = np.array([[1, 1, 1], [1, 0, 1], [1, 1, 1]], np.uint8)
+        junction = skeleton & (ndimage.convolve(skeleton.astype(np.uint8), kernel, mode='constant', cval=0) >= 3)
+        cut = box_sums(junction) - box_sums(junction, y1 + 1, y2 - 1, x1 + 1, x2 - 1) > 0
+        for i in np.flatnonzero(cut):
+            degree, branch_length[i] = skeleton_links(skeleton[y1[i]:y2[i], x1[i]:x2[i]])
+            endpoints[i] = np.count_nonzero(degree == 1)
+            branch_points[i] = np.count_nonzero(degree == 3)
+    else:
+        #endpoints: free ends (degree < 2) of the separate branches and of the branches with one endpoint
+        free = summary[summary['branch_type'].isin([0, 1])]
+        ends = np.concatenate([free['node_id_src'], free['node_id_dst']])
+        ends = ends[sk.degrees[ends] < 2]
+        endpoints = window_sums(np.ones(len(ends)), ends)
+
+        #branch points
+        branch_points = box_sums(skeleton_degrees(skel) == 3)
+
+        #branch length, every step counts half on each of its pixels
+        branch_length = window_sums(np.concatenate([step_length, step_length]) / 2, np.concatenate([step_src, step_dst]))
+
+    long_branches = np.flatnonzero(summary['branch_distance'].to_numpy() >= min_pixels)
+    curv_windows = [w for w in windows_curvature if w <= window_size]
+    if clip:
+        #curvature of the runs of the branches in every window, for every curvature window
+        run_curvatures = [[[] for w in curv_windows] for i in range(len(x1))]
+        n_runs = np.zeros(len(x1), int)
+        for branch in long_branches:
+            branch_coords = sk.path_coordinates(branch).astype(int)
+            rows, cols = branch_coords[:, 0], branch_coords[:, 1]
+            branch_runs = {}
+            through = np.flatnonzero((y1 <= rows.max()) & (y2 > rows.min()) & (x1 <= cols.max()) & (x2 > cols.min()) & ~cut)
+            for i in through:
+                inside = (rows >= y1[i]) & (rows < y2[i]) & (cols >= x1[i]) & (cols < x2[i])
+                edges = np.flatnonzero(np.diff(np.concatenate([[False], inside, [False]])))
+                for start, stop in zip(edges[::2], edges[1::2]):
+                    run = branch_coords[start:stop]
+                    distance = np.sum(np.hypot(*np.diff(run, axis=0).T))
+                    if len(run) < 2 or distance < min_pixels:
+                        continue
+                    #the same run is in many overlapping windows
+                    if (start, stop) not in branch_runs:
+                        #skan starts the branches of the patch at their end that comes first in raster order
+                        if tuple(run[-1]) < tuple(run[0]):
+                            run = run[::-1]
+                        run = [(int(y), int(x)) for y, x in run]
+                        branch_runs[start, stop] = [curvature(run, window=w) / distance for w in curv_windows]
+                    n_runs[i] += 1
+                    for k, curv in enumerate(branch_runs[start, stop]):
+                        run_curvatures[i][k].append(curv)
+
+        curvature_mean = np.full(len(x1), np.nan)
+        for i in range(len(x1)):
+            if cut[i]:
+                curvature_mean[i] = patch_curvature(skeleton[y1[i]:y2[i], x1[i]:x2[i]], windows_curvature, window_size, min_pixels)
+            elif n_runs[i] and curv_windows:
+                #mean over the runs without the NaN (as pandas), averaged over the curvature windows
+                curvature_mean[i] = np.mean([pd.Series(values, dtype=float).mean() for values in run_curvatures[i]])
+    else:
+        #curvature of the branches at their middle pixel
+        middle = paths.indices[paths.indptr[long_branches] + (np.diff(paths.indptr)[long_branches] // 2)]
+        curv_values, curv_present = [], []
+        for w in windows_curvature:
+            if w <= window_size:
+                curv = np.array([curvature([(int(y), int(x)) for y, x in sk.path_coordinates(branch)], window=w)
+                                 for branch in long_branches], dtype=float)
+                curv = curv / summary['branch_distance'].to_numpy()[long_branches]
+                valid = ~np.isnan(curv)
+                n_valid = window_sums(valid.astype(float), middle)
+                curv_sum = window_sums(np.where(valid, curv, 0), middle)
+                #mean over the branches in the window, NaN if none of them has a curvature
+                curv_values.append(np.where(n_valid > 0, curv_sum / np.maximum(n_valid, 1), np.nan))
+                #a curvature window only counts if there is a branch in the window
+                curv_present.append(window_sums(np.ones(len(middle)), middle) > 0)
+        if curv_values:
+            curv_values, curv_present = np.array(curv_values), np.array(curv_present)
+            n_present = curv_present.sum(axis=0)
+            curvature_mean = np.where(n_present > 0, np.where(curv_present, curv_values, 0).sum(axis=0) / np.maximum(n_present, 1), np.nan)
+        else:
+            curvature_mean = np.full(len(x1), np.nan)
+
+    return {'endpoints': endpoints, 'branch_points': branch_points, 'branch_length': branch_length,
+            'curvature_mean': curvature_mean}
+
 ####### ---MAIN FUNCTION--- ######
 
 def run_multiscale_ridge_detection(
@@ -372,8 +673,18 @@ def run_multiscale_ridge_detection(
     prune_short,
     contrastLow,
     contrastHigh,
-    darkline
+    darkline,
+    ridge_engine='per_width',
+    n_workers=1,
+    report_timings=False
 ):
+    #ridge_engine: 'per_width' smooths the image from scratch for every line width, 'scale_space' smooths every line width
+    #from the previous one (the same masks up to rounding), 'pyramid' also decimates the coarse line widths (approximate)
+    #n_workers: threads for the 'per_width' line widths, the scale space engines compute one line width after the other
+    #report_timings: print the time of every line width
+    if ridge_engine not in ('per_width', 'scale_space', 'pyramid'):
+        raise ValueError("ridge_engine must be 'per_width', 'scale_space' or 'pyramid'")
+
     #check that image is in uint8 format, if not - convert to uint8 for better workability of contrast enhancement and ridge detection.
     if image.dtype != np.uint8:
         img8 = (255 * (image - image.min()) / (image.max() - image.min())).astype(np.uint8)
@@ -392,29 +703,62 @@ def run_multiscale_ridge_detection(
     if im_mask is not None:
       im_mask = im_mask.astype(bool)
 
-    # frist LW
-    lw = minLineWidth
-
-    #start ridge detection for the first line width 
-    #mask_lw is a boolean mask of detected ridge points after filtration and background pixels exclusion
-    #responce is a responce array after ridgge detector after filtration and background pixels exclusion
-    # lower and upper are thresholds for the ridge detector for this defined line widths 
-    mask_lw, response, lower, upper = ridge_mask_for_linewidth(
-    img, lw, im_mask,
-    contrastLow, contrastHigh, darkline
-    )
-    #define new var to copy the mask for the first line width 
-    combined_mask = mask_lw.copy()
-
-    # other LW
-    for lw in range(minLineWidth + 1, maxLineWidth + 1):
+    #seconds of every line width
+    timings = {}
+    start = time.perf_counter()
+
+    if ridge_engine != 'per_width':
+        #all line widths from one gaussian scale space
+        for lw, mask_lw in ridge_masks_scale_space(
+            img, range(minLineWidth, maxLineWidth + 1), im_mask,
+            contrastLow, contrastHigh, darkline, downsample=ridge_engine == 'pyramid'
+        ):
+            combined_mask = mask_lw if combined_mask is None else combined_mask | mask_lw
+            timings[lw] = time.perf_counter() - start
+            start = time.perf_counter()
+    elif n_workers > 1:
+        #line widths in parallel threads (the filters release the GIL). Every thread returns its mask packed in bits,
+        #which are ORed as they come, so there are never more than n_workers boolean masks at once
+        combined_bits = np.zeros(-(-img.size // 8), np.uint8)
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            futures = [pool.submit(packed_ridge_mask_for_linewidth, img, lw, im_mask, contrastLow, contrastHigh, darkline)
+                       for lw in range(minLineWidth, maxLineWidth + 1)]
+            for future in as_completed(futures):
+                lw, bits, timings[lw] = future.result()
+                combined_bits |= bits
+        combined_mask = np.unpackbits(combined_bits, count=img.size).reshape(img.shape).view(bool)
+    else:
+        # frist LW
+        lw = minLineWidth
+
+        #start ridge detection for the first line width 
+        #mask_lw is a boolean mask of detected ridge points after filtration and background pixels exclusion
+        #responce is a responce array after ridgge detector after filtration and background pixels exclusion
+        # lower and upper are thresholds for the ridge detector for this defined line widths 
+        #one response buffer for all line widths
+        response = np.empty(img.shape, np.float32)
         mask_lw, response, lower, upper = ridge_mask_for_linewidth(
         img, lw, im_mask,
-        contrastLow, contrastHigh, darkline
+        contrastLow, contrastHigh, darkline, out=response
         )
-        #Combining scales by logical OR to get the final mask of ridges of different widths
-        combined_mask |= mask_lw
-
+        #define new var to copy the mask for the first line width 
+        combined_mask = mask_lw.copy()
+        timings[lw] = time.perf_counter() - start
+
+        # other LW
+        for lw in range(minLineWidth + 1, maxLineWidth + 1):
+            start = time.perf_counter()
+            mask_lw, response, lower, upper = ridge_mask_for_linewidth(
+            img, lw, im_mask,
+            contrastLow, contrastHigh, darkline, out=response
+            )
+            #Combining scales by logical OR to get the final mask of ridges of different widths
+            combined_mask |= mask_lw
+            timings[lw] = time.perf_counter() - start
+
+    if report_timings:
+        for lw in sorted(timings):
+            print(f"line width {lw}: {timings[lw]:.3f} s")
     
     if do_skeleton:
         skel = skeletonize(combined_mask)
@@ -428,11 +772,185 @@ def run_multiscale_ridge_detection(
 
     return combined_mask, skel
 
+def image_segmentation_features(
+        im, label, x, y,
+        windows_curvature, window_size,
+        im_mask, intensity_clip_percent, minLineWidth, maxLineWidth,
+        minimumBranchLength, do_skeleton, do_enhance_contrast, prune_short, contrastLow, contrastHigh, darkline,
+        ridge_engine='per_width', n_workers=1, skeleton_mode='patch'
+    ):
+    #skeleton_mode: 'patch' cuts the skeleton at the borders of every window and analyses every window on its own,
+    #'image_clipped' builds the skeleton graph of the whole image once and cuts its branches at the window borders
+    #(the skeleton features of 'patch', see image_skeleton_window_features), 'image' builds the graph once without cutting the branches, so none of its
+    #skeleton features are the ones of 'patch' near the window borders
+
+    #empty list to save records of features for each patch of the image
+    records = []
+
+    # check if there is an image mask
+    if im_mask is None:
+        im_mask = np.ones_like(im).astype('bool')
+        #make all image valuable
+    else:
+        # make sure the input mask is a boolean
+        im_mask = im_mask.astype('bool')
+
+
+    mask, skel = run_multiscale_ridge_detection(
+        im,
+        im_mask,
+        minLineWidth=minLineWidth,
+        maxLineWidth=maxLineWidth,
+        minimumBranchLength=minimumBranchLength,
+        do_skeleton=do_skeleton,
+        do_enhance_contrast=do_enhance_contrast,
+        intensity_clip_percent=intensity_clip_percent,
+        prune_short=prune_short,
+        contrastLow=contrastLow,
+        contrastHigh=contrastHigh,
+        darkline=darkline,
+        ridge_engine=ridge_engine,
+        n_workers=n_workers
+    )
+    if skel is None:
+        return records
+    # extract X,Y coords
+    x_flat = np.ravel(x).astype(int) #extract x patch coords and make it 1D array
+    y_flat = np.ravel(y).astype(int) #extract y patch coords and make it 1D array
+
+    half = window_size // 2 #half of the patch size 
+    H, W = im.shape #extract height and width of the image
+
+    if skeleton_mode in ('image', 'image_clipped'):
+        #skeleton features of all the windows from one skeleton graph of the whole image
+        skeleton_features = image_skeleton_window_features(
+            skel, np.clip(x_flat - half, 0, W), np.clip(x_flat + half, 0, W),
+            np.clip(y_flat - half, 0, H), np.clip(y_flat + half, 0, H),
+            windows_curvature, window_size, minimumBranchLength, clip=skeleton_mode == 'image_clipped'
+        )
+    elif skeleton_mode != 'patch':
+        raise ValueError("skeleton_mode must be 'patch', 'image_clipped' or 'image'")
+
+    #take all overlap coordinates in x_flat and y_flat
+    for index, (xx, yy) in enumerate(zip(x_flat, y_flat)):
+        xx_i = int(xx) #take x coord
+        yy_i = int(yy) #take y coord
+
+        x1 = xx_i - half #left border
+        x2 = xx_i + half #right border
+        y1 = yy_i - half #bottom border
+        y2 = yy_i + half #top border
+        
+        if skel is None:
+            continue 
+        
+        if x1 < 0 or y1 < 0 or x2 > W or y2 > H:
+          continue #skip patches that are out of image borders
+        else:
+          patch = skel[y1:y2, x1:x2] #extract skeleton from patch 
+          if patch is None or np.count_nonzero(patch) == 0:
+            continue
+          im_patch = im[y1:y2, x1:x2] #extract image patch for not skeleton based features
+          mask_patch = mask[y1:y2, x1:x2] #extract mask patch for Ridge-Detector based features
+          
+          #Intensity
+          mean_int = float(np.mean(im_patch))
+          
+          #HDM
+          HDM_value = np.count_nonzero(mask_patch) / mask_patch.size
+
+          if skeleton_mode != 'patch':
+            #endpoints, branch points, length and curvature of the window from the skeleton graph of the whole image
+            m = int(skeleton_features['endpoints'][index])
+            n_branchpoints = int(skeleton_features['branch_points'][index])
+            branch_length = skeleton_features['branch_length'][index]
+            curvature_mean = skeleton_features['curvature_mean'][index]
+          else:
+            #skeleton graph
+            from skan import Skeleton, summarize
+            if np.count_nonzero(patch) == 0:
+              continue
+            
+            if patch is None or np.count_nonzero(patch) == 0:
+              continue
+            patch_bool = patch.astype(bool)
+            if np.count_nonzero(patch_bool) == 0:
+              continue
+
+            try:
+              sk = Skeleton(patch_bool, spacing=1)
+              branch_data = summarize(sk, separator='_')
+            except ValueError:
+              continue
+
+            patch_bool = patch.astype(bool)
+            #if np.count_nonzero(patch_bool) == 0:
+              #continue
+
+            #branch_data = summarize(Skeleton(patch_bool, spacing=1), separator='_')
+            branch_data = branch_data.drop_duplicates()
+            branch_length = branch_data['branch_distance'].sum()
+
+            # endpoints
+            branch_types = branch_data['branch_type'].value_counts()
+
+            m = 0
+            m += branch_types.get(0, 0) * 2  # separate branch (two endpoints)
+            m += branch_types.get(1, 0) * 1  # endpoints
+
+            #branch points (skeleton_degrees of the patch, the degrees change where the skeleton is cut)
+            n_branchpoints = int(np.count_nonzero(skeleton_degrees(patch) == 3))
+
+            #curvature
+            curvature_mean = patch_curvature(patch, windows_curvature, window_size, minimumBranchLength)
+
+          # normalization
+          if branch_length > 0:
+              norm_end = m / branch_length
+              norm_branch = n_branchpoints / branch_length
+          else:
+              norm_end = np.nan
+              norm_branch = np.nan
+
+          #ffd
+          H_patch, W_patch = patch.shape
+          ys, xs = np.where(patch > 0)
+          x_norm = xs / (W_patch - 1)
+          y_norm = ys / (H_patch - 1)
+          points = np.column_stack([x_norm, y_norm])
+
+          scales = np.logspace(np.log10(0.02),np.log10(0.25), 5)
+          result = box_counting(points, scales, method="oversample")
+
+          #print("Fractal Dimension:", result["fd"])
+
+          #lacunarity (use the formula drectly from TWOMBLI)
+          lac_value = abs((((im_patch.std())**2)/((im_patch.mean())**2)) - 1)
+
+          #record
+          records.append({
+              "image_name": label,
+              "ECM_x": xx_i,
+              "ECM_y": yy_i,
+              "intensity": mean_int,
+              "HDM": HDM_value,
+              "endpoints": m,
+              "norm_endpoints": norm_end,
+              "norm_branch": norm_branch,
+              "curvature_mean": curvature_mean,
+              "branch_points": n_branchpoints,
+              "FFD": result["fd"],
+              "lacunarity": lac_value,
+          })
+
+    return records
+
 def segmentation_features(
         im_list,
         windows_curvature, window_size, overlap,
         im_mask, intensity_thresh, intensity_clip_percent, eccentricity_thresh, minLineWidth, maxLineWidth,
-        minimumBranchLength, do_skeleton, do_enhance_contrast, prune_short, contrastLow, contrastHigh, darkline
+        minimumBranchLength, do_skeleton, do_enhance_contrast, prune_short, contrastLow, contrastHigh, darkline,
+        cache_dir=None, ridge_engine='per_width', n_workers=1, skeleton_mode='patch'
     ):
 
     #empty list to save records of features for each patch
@@ -444,171 +962,25 @@ def segmentation_features(
         label = os.path.splitext(os.path.basename(im_path))[0]
 
         #read image
-        im = img_as_float(io.imread(im_path))
-        if im.ndim == 3:
-            im = im[0]
+        im_raw = io.imread(im_path)
+        if im_raw.ndim == 3:
+            im_raw = im_raw[0]
+        im = img_as_float(im_raw)
 
-        #extract coords of patches
+        #extract coords of patches (from the raw image, as the other callers, so they share its cached orientation field)
         x, y, u, v, im_theta, im_ecc = AFT.image_local_order(
-            im, window_size, overlap,
+            im_raw, window_size, overlap,
             im_mask, intensity_thresh, eccentricity_thresh,
             plot_overlay=False, plot_angles=False, plot_eccentricity=False,
-            save_figures=False, save_path=''
+            save_figures=False, save_path='', n_workers=n_workers, cache_dir=cache_dir
         )
 
-
-        # check if there is an image mask
-        if im_mask is None:
-            im_mask = np.ones_like(im).astype('bool')
-            #make all image valuable
-        else:
-            # make sure the input mask is a boolean
-            im_mask = im_mask.astype('bool')
-
-
-        mask, skel = run_multiscale_ridge_detection(
-            im,
-            im_mask,
-            minLineWidth=minLineWidth,
-            maxLineWidth=maxLineWidth,
-            minimumBranchLength=minimumBranchLength,
-            do_skeleton=do_skeleton,
-            do_enhance_contrast=do_enhance_contrast,
-            intensity_clip_percent=intensity_clip_percent,
-            prune_short=prune_short,
-            contrastLow=contrastLow,
-            contrastHigh=contrastHigh,
-            darkline=darkline
-        )
-        if skel is None:
-            continue
-        # extract X,Y coords
-        x_flat = np.ravel(x).astype(int) #extract x patch coords and make it 1D array
-        y_flat = np.ravel(y).astype(int) #extract y patch coords and make it 1D array
-
-        half = window_size // 2 #half of the patch size 
-        H, W = im.shape #extract height and width of the image
-
-        #take all overlap coordinates in x_flat and y_flat
-        for xx, yy in zip(x_flat, y_flat):
-            xx_i = int(xx) #take x coord
-            yy_i = int(yy) #take y coord
-
-            x1 = xx_i - half #left border
-            x2 = xx_i + half #right border
-            y1 = yy_i - half #bottom border
-            y2 = yy_i + half #top border
-            
-            if skel is None:
-                continue 
-            
-            if x1 < 0 or y1 < 0 or x2 > W or y2 > H:
-              continue #skip patches that are out of image borders
-            else:
-              patch = skel[y1:y2, x1:x2] #extract skeleton from patch 
-              if patch is None or np.count_nonzero(patch) == 0:
-                continue
-              im_patch = im[y1:y2, x1:x2] #extract image patch for not skeleton based features
-              mask_patch = mask[y1:y2, x1:x2] #extract mask patch for Ridge-Detector based features
-              
-              #Intensity
-              mean_int = float(np.mean(im_patch))
-              
-              #HDM
-              HDM_value = np.count_nonzero(mask_patch) / mask_patch.size
-
-              #skeleton graph
-              from skan import Skeleton, summarize
-              if np.count_nonzero(patch) == 0:
-                continue
-              
-              if patch is None or np.count_nonzero(patch) == 0:
-                continue
-              patch_bool = patch.astype(bool)
-              if np.count_nonzero(patch_bool) == 0:
-                continue
-
-              try:
-                sk = Skeleton(patch_bool, spacing=1)
-                branch_data = summarize(sk, separator='_')
-              except ValueError:
-                continue
-
-              patch_bool = patch.astype(bool)
-              #if np.count_nonzero(patch_bool) == 0:
-                #continue
-
-              #branch_data = summarize(Skeleton(patch_bool, spacing=1), separator='_')
-              branch_data = branch_data.drop_duplicates()
-
-              # endpoints
-              branch_types = branch_data['branch_type'].value_counts()
-
-              m = 0
-              m += branch_types.get(0, 0) * 2  # separate branch (two endpoints)
-              m += branch_types.get(1, 0) * 1  # endpoints
-
-              #branch points
-              sk = Skeleton(patch, spacing=1)
-              G = skeleton_to_nx(sk)
-              branch_point = []
-              for i in G.degree:
-                branch_point.append(i[1] == 3)
-              n_branchpoints = branch_point.count(True)
-              #print(branch_points)
-
-              # normalization
-              if branch_data['branch_distance'].sum() > 0:
-                  norm_end = m / branch_data['branch_distance'].sum()
-                  norm_branch = n_branchpoints / branch_data['branch_distance'].sum()
-              else:
-                  norm_end = np.nan
-                  norm_branch = np.nan
-
-              #ffd
-              H_patch, W_patch = patch.shape
-              ys, xs = np.where(patch > 0)
-              x_norm = xs / (W_patch - 1)
-              y_norm = ys / (H_patch - 1)
-              points = np.column_stack([x_norm, y_norm])
-
-              scales = np.logspace(np.log10(0.02),np.log10(0.25), 5)
-              result = box_counting(points, scales, method="oversample")
-
-              #print("Fractal Dimension:", result["fd"])
-
-              #lacunarity (use the formula drectly from TWOMBLI)
-              lac_value = abs((((im_patch.std())**2)/((im_patch.mean())**2)) - 1)
-
-              #curvature
-              curv_values = []
-
-              for w in windows_curvature:
-                if w <= window_size:
-                    df_curv = compute_curvature_from_skeleton(
-                        patch,
-                        windows=[w],
-                        min_pixels=minimumBranchLength
-                    )
-                    col = f"curvature_w{w}"
-                    if col in df_curv.columns:
-                        curv_values.append(df_curv[col].mean())
-              curvature_mean = np.mean(curv_values) if curv_values else np.nan
-
-              #record
-              records.append({
-                  "image_name": label,
-                  "ECM_x": xx_i,
-                  "ECM_y": yy_i,
-                  "intensity": mean_int,
-                  "HDM": HDM_value,
-                  "endpoints": m,
-                  "norm_endpoints": norm_end,
-                  "norm_branch": norm_branch,
-                  "curvature_mean": curvature_mean,
-                  "branch_points": n_branchpoints,
-                  "FFD": result["fd"],
-                  "lacunarity": lac_value,
-              })
+        records.extend(image_segmentation_features(
+            im, label, x, y,
+            windows_curvature, window_size,
+            im_mask, intensity_clip_percent, minLineWidth, maxLineWidth,
+            minimumBranchLength, do_skeleton, do_enhance_contrast, prune_short, contrastLow, contrastHigh, darkline,
+            ridge_engine=ridge_engine, n_workers=n_workers, skeleton_mode=skeleton_mode
+        ))
 
     return pd.DataFrame(records)